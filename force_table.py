@@ -2,41 +2,38 @@
 
 """
 This code provides a method to perform sensitivity analysis of the Metadynamics parameters 'w' and 'sigma'.
+See run_ebmetad.sweep for the library interface.
 """
 
-import run_ebmetad.pair_data as pd
+from run_ebmetad.metadata import dump_json
+from run_ebmetad.sweep import combination_key, iter_force_tables, load_pairs, run_sweep
 import argparse
 import sys
-import json
 
 sys.path.append('/home/jennifer/Git/sample_restraint/build/src/pythonmodule')
 
 
-def force_table(weights=[0.1], sigmas=[0.2]):
-
+def force_table(pairs_json, weights=[0.1], sigmas=[0.2], cache=False):
+    """
+    Build every force table of a sweep in memory. Only suitable for small sweeps; see run_sweep otherwise.
+    :param pairs_json: path to the pair data.
+    :param weights: list of w values.
+    :param sigmas: list of sigma values.
+    :param cache: read the pair data through the binary sidecar cache.
+    :return: dictionary of combination key -> pair name -> force table.
+    """
     force_table = {}
-
-    multi_pair = pd.MultiPair()
-    multi_pair.read_from_json(args.f)
-
-    # We'll make a whole bunch of these tables for different values of w and sigma
-    for w in weights:
-        for s in sigmas:
-            key = 'w{}_s{}'.format(w, s)
-            force_table[key] = {}
-
-            for name in multi_pair.get_names():
-                idx = multi_pair.name_to_id(name)
-                ft = multi_pair[idx].build_force_table(w=w, sigma=s)
-                force_table[key][name] = ft
+    for w, s, tables in iter_force_tables(load_pairs(pairs_json, cache), weights, sigmas):
+        force_table[combination_key(w, s)] = tables
     return force_table
 
 
-if __name__ == '__main__':
+def main(argv=None):
     parser = argparse.ArgumentParser(
         "Builds a force table for specified w and sigma")
     parser.add_argument(
         '-f',
+        required=True,
         help=
         'path to json of pair data; should include the smoothed DEER distribution and a '
         'list of associated distance bins. See pair_data.json in the tests/ directory'
@@ -44,16 +41,44 @@ if __name__ == '__main__':
     parser.add_argument(
         '-w',
         nargs='+',
+        default=[0.1],
         help="weight, or height, of Gaussians (as in standard metadynmaics).",
         type=float)
     parser.add_argument(
-        '-s', nargs='+', help="sigma. Width of Gaussians", type=float)
+        '-s', nargs='+', default=[0.2], help="sigma. Width of Gaussians", type=float)
     parser.add_argument(
         '-o',
+        required=True,
         help=
-        "path to where the force table will be stored. For now, stored as json."
+        "path to where the force tables will be stored: a directory of .npz files with an index.json (npz format), "
+        "or a single json file (json format)."
     )
-    args = parser.parse_args()
+    parser.add_argument(
+        '--format',
+        choices=['npz', 'json'],
+        default='npz',
+        help="npz streams one file per (w, sigma) combination with bounded memory; json holds the whole sweep in "
+        "memory.")
+    parser.add_argument(
+        '--mpi',
+        action='store_true',
+        help="distribute the sweep over MPI ranks (npz format; launch with mpirun, requires mpi4py).")
+    parser.add_argument('-j', type=int, help="number of worker processes (npz format; default: number of cores)")
+    parser.add_argument(
+        '--cache',
+        action='store_true',
+        help="read the pair data through a binary sidecar cache (written next to the json on first use).")
+    args = parser.parse_args(argv)
+
+    if args.format == 'json':
+        dump_json(force_table(args.f, weights=args.w, sigmas=args.s, cache=args.cache), args.o, indent=2)
+    elif args.mpi:
+        # Imported here so that mpi4py is only needed for MPI runs
+        from run_ebmetad.mpi import mpi_sweep
+        mpi_sweep(args.f, args.w, args.s, args.o, cache=args.cache)
+    else:
+        run_sweep(args.f, args.w, args.s, args.o, max_workers=args.j, cache=args.cache)
 
-    ft = force_table(weights=args.w, sigmas=args.s)
-    json.dump(ft, open(args.o, 'w'), indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+"""
+Aggregates the historical distance counts of every ensemble member into a single (members x pairs x bins) array.
+"""
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from run_ebmetad.counts import counts_filename, file_signature, read_counts
+from run_ebmetad.directory_helper import DirectoryHelper
+
+
+class CountsAggregator:
+    """
+    Reads counts_{name}.log from every ensemble_dir/mem_{n} directory in parallel.
+    Files are cached by signature, so re-aggregating only reads the files whose size or mtime changed.
+    Pairs with fewer bins than the largest pair are zero-padded.
+    """
+
+    def __init__(self, ensemble_dir, pairs, max_workers=None):
+        """
+        :param ensemble_dir: path to top directory which contains the full ensemble.
+        :param pairs: MultiPair object; determines the pair order and number of bins.
+        :param max_workers: size of the thread pool used to read the files.
+        """
+        self.ens_dir = ensemble_dir
+        self.names = list(pairs.get_names())
+        self.nbins = max(len(pd.get('bins')) for pd in pairs)
+        self.max_workers = max_workers
+        self.members = []
+        self.counts = np.zeros((0, len(self.names), self.nbins), dtype=np.int64)
+        self._cache = {}
+
+    def __read(self, fnm):
+        signature = file_signature(fnm)
+        if signature is None:
+            return fnm, None, None
+        cached = self._cache.get(fnm)
+        if cached is not None and cached[0] == signature:
+            return fnm, signature, cached[1]
+        return fnm, signature, read_counts(fnm)
+
+    def aggregate(self):
+        """
+        Discover the ensemble members and (re-)read any counts files that have changed.
+        :return: integer array of shape (members, pairs, bins). Missing files give rows of zeros.
+        """
+        self.members = DirectoryHelper.list_members(self.ens_dir)
+        files = []
+        for member in self.members:
+            member_dir = DirectoryHelper(top_dir=self.ens_dir, ensemble_num=member).get_dir('ensemble_num')
+            files.extend([os.path.join(member_dir, counts_filename(name)) for name in self.names])
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            results = list(executor.map(self.__read, files))
+
+        counts = np.zeros((len(self.members), len(self.names), self.nbins), dtype=np.int64)
+        flat = counts.reshape(-1, self.nbins)
+        self._cache = {}
+        for row, (fnm, signature, data) in enumerate(results):
+            if signature is None:
+                continue
+            self._cache[fnm] = (signature, data)
+            n = min(len(data), self.nbins)
+            flat[row, :n] = data[:n]
+        self.counts = counts
+        return counts
+
+    def summed(self):
+        """
+        :return: the counts summed over ensemble members, shape (pairs, bins).
+        """
+        return self.counts.sum(axis=0)
+
+    def save(self, fnm='ensemble_counts.npz'):
+        """
+        Write the aggregated counts, member numbers and pair names to a single binary file.
+        :param fnm: output path (.npz).
+        """
+        np.savez(fnm, counts=self.counts, members=np.array(self.members, dtype=np.int64),
+                 names=np.array(self.names))
+
+    @staticmethod
+    def load(fnm='ensemble_counts.npz'):
+        """
+        :param fnm: a file written by save().
+        :return: (counts, members, names)
+        """
+        with np.load(fnm) as data:
+            return data['counts'], data['members'].tolist(), data['names'].tolist()
@@ -0,0 +1,131 @@
+"""
+Bias potentials and forces implied by EBMetaD force tables and distance count histories.
+Force tables are indexed [current distance, historical distance] and hold the force divided by the current distance;
+contracting the historical axis with a counts history gives the force (or potential) profile along the current
+distance, which is then interpolated at arbitrary distances. Everything is vectorized, and long trajectories can be
+streamed in chunks.
+"""
+
+import numpy as np
+
+
+def integrate_force_table(force_table, bins, sigma):
+    """
+    Integrate a force table into a potential table. Force tables store the force divided by the current distance
+    (the plugin multiplies them by the distance vector): entry [i, j] is A_j * (1 - d_j / d_i) * g(d_i - d_j), with
+    g(x) = exp(-x^2 / 2 sigma^2) and A_j the amplitude of column j (see PairData.build_force_table). The force
+    d_i * entry = A_j * (d_i - d_j) * g(d_i - d_j) integrates in closed form to
+        U(d_i, j) = A_j * sigma^2 * g(d_i - d_j),
+    which vanishes far from d_j. The amplitudes are recovered from the off-diagonal neighbour of each column; columns
+    that are zero in the table (a history at zero distance) stay zero.
+    :param force_table: (nbins, nbins) force table.
+    :param bins: distance bins (uniform or not).
+    :param sigma: width of the Gaussians the table was built with.
+    :return: (nbins, nbins) float64 potential table.
+    """
+    force_table = np.asarray(force_table, dtype=np.float64)
+    bins = np.asarray(bins, dtype=np.float64)
+    nbins = len(bins)
+    if nbins < 2:
+        raise ValueError('Need at least two bins to integrate a force table')
+    gaussian = np.exp(-(bins[:, None] - bins[None, :])**2 / (2 * sigma**2))
+    columns = np.arange(nbins)
+    rows = np.where(columns < nbins - 1, columns + 1, columns - 1)
+    # entry [i, j] * d_i / (d_i - d_j) = A_j * g(d_i - d_j)
+    numerator = force_table[rows, columns] * bins[rows]
+    denominator = (bins[rows] - bins[columns]) * gaussian[rows, columns]
+    amplitudes = np.divide(numerator, denominator, out=np.zeros(nbins), where=denominator != 0)
+    return amplitudes[None, :] * sigma**2 * gaussian
+
+
+def iter_chunks(distances, chunk_size):
+    """
+    Split an array (or memory map) of distances into consecutive chunks along the first axis.
+    :param distances: array-like of distances.
+    :param chunk_size: number of frames per chunk.
+    """
+    for start in range(0, len(distances), chunk_size):
+        yield np.asarray(distances[start:start + chunk_size], dtype=np.float64)
+
+
+class BiasEvaluator:
+    """
+    Evaluates the EBMetaD bias of a single restraint for arrays of distances.
+    """
+
+    def __init__(self, force_table, bins, sigma, counts=None):
+        """
+        :param force_table: (nbins, nbins) force table, e.g. from PairData.build_force_table.
+        :param bins: distance bins of the table.
+        :param sigma: width of the Gaussians the table was built with.
+        :param counts: default distance counts history (e.g. the restraint's distance_counts).
+        """
+        self.force_table = np.asarray(force_table, dtype=np.float64)
+        self.bins = np.asarray(bins, dtype=np.float64)
+        self.sigma = sigma
+        self.counts = None if counts is None else np.asarray(counts, dtype=np.float64)
+        self._potential_table = None
+
+    @property
+    def potential_table(self):
+        if self._potential_table is None:
+            self._potential_table = integrate_force_table(self.force_table, self.bins, self.sigma)
+        return self._potential_table
+
+    def __counts(self, counts):
+        if counts is None:
+            if self.counts is None:
+                raise ValueError('Must provide a distance counts history')
+            return self.counts
+        return np.asarray(counts, dtype=np.float64)
+
+    def force_profile(self, counts=None):
+        """
+        :param counts: distance counts history; defaults to the one given at construction.
+        :return: total force at every bin (the table entries times the current distance).
+        """
+        return self.bins * self.force_table.dot(self.__counts(counts))
+
+    def potential_profile(self, counts=None):
+        """
+        :param counts: distance counts history; defaults to the one given at construction.
+        :return: total bias potential at every bin.
+        """
+        return self.potential_table.dot(self.__counts(counts))
+
+    def force(self, distances, counts=None):
+        """
+        Force at arbitrary distances, linearly interpolated between bins.
+        :param distances: scalar or array of distances.
+        :param counts: distance counts history; defaults to the one given at construction.
+        :return: forces with the same shape as distances.
+        """
+        return np.interp(distances, self.bins, self.force_profile(counts))
+
+    def bias(self, distances, counts=None, chunk_size=2**20):
+        """
+        Bias potential at arbitrary distances, linearly interpolated between bins.
+        :param distances: array of distances (may be a memory map of a long trajectory).
+        :param counts: distance counts history; defaults to the one given at construction.
+        :param chunk_size: number of frames converted to float64 at a time.
+        :return: bias potential per distance.
+        """
+        profile = self.potential_profile(counts)
+        if np.ndim(distances) == 0:
+            return float(np.interp(distances, self.bins, profile))
+        bias = np.empty(len(distances))
+        for start in range(0, len(distances), chunk_size):
+            chunk = np.asarray(distances[start:start + chunk_size], dtype=np.float64)
+            bias[start:start + len(chunk)] = np.interp(chunk, self.bins, profile)
+        return bias
+
+    def bias_stream(self, chunks, counts=None):
+        """
+        Stream the bias of a trajectory delivered in chunks, without holding it in memory.
+        :param chunks: iterable of distance arrays (see iter_chunks).
+        :param counts: distance counts history; defaults to the one given at construction.
+        :return: generator of bias arrays, one per chunk.
+        """
+        profile = self.potential_profile(counts)
+        for chunk in chunks:
+            yield np.interp(chunk, self.bins, profile)
@@ -0,0 +1,50 @@
+"""
+Helpers for distance bin grids, uniform or not.
+A grid is given by its bins (the distances at which distributions and force tables are tabulated); bin i covers
+[bins[i], bins[i + 1]), and the last bin is as wide as the one before it.
+"""
+
+import numpy as np
+
+
+def bin_edges(bins):
+    """
+    :param bins: distance bins.
+    :return: array of nbins + 1 bin edges.
+    """
+    bins = np.asarray(bins, dtype=np.float64)
+    return np.append(bins, bins[-1] + (bins[-1] - bins[-2]))
+
+
+def is_uniform(bins, rtol=1E-6):
+    """
+    :param bins: distance bins.
+    :param rtol: relative tolerance on the spacing.
+    :return: True if all bins have the same width.
+    """
+    widths = np.diff(np.asarray(bins, dtype=np.float64))
+    return bool(np.allclose(widths, widths[0], rtol=rtol, atol=0))
+
+
+class BinIndex:
+    """
+    Precomputed search index for distance -> bin lookups on an arbitrary grid.
+    """
+
+    def __init__(self, bins):
+        self.bins = np.asarray(bins, dtype=np.float64)
+        self.edges = bin_edges(self.bins)
+        self.widths = np.diff(self.edges)
+        self.uniform = is_uniform(self.bins)
+
+    def __len__(self):
+        return len(self.bins)
+
+    def lookup(self, distances):
+        """
+        Vectorized distance -> bin lookup. Distances outside the grid are assigned to the first or last bin.
+        :param distances: scalar or array of distances.
+        :return: integer bin indices with the same shape as distances.
+        """
+        idx = np.searchsorted(self.edges, distances, side='right') - 1
+        return np.clip(idx, 0, len(self.bins) - 1)
@@ -0,0 +1,162 @@
+"""
+Monitors how close the sampled distance distributions of a running ensemble are to the target DEER distributions.
+A poll only reads the counts files that have changed since the previous one (see counts.CountsFile).
+"""
+
+import os
+import time
+import threading
+import numpy as np
+from run_ebmetad.counts import CountsFile, counts_filename
+from run_ebmetad.directory_helper import DirectoryHelper
+
+
+def _normalize(probs, eps):
+    probs = np.asarray(probs, dtype=float) + eps
+    return probs / np.sum(probs, axis=-1, keepdims=True)
+
+
+def kl_divergence(p, q, eps=1e-12):
+    """
+    Kullback-Leibler divergence D(p || q), computed along the last axis.
+    :param p: reference (target) distribution(s). Need not be normalized.
+    :param q: sampled distribution(s). Need not be normalized.
+    :param eps: small value added to every bin to keep the logarithm finite.
+    :return: the divergence (scalar or array).
+    """
+    p = _normalize(p, eps)
+    q = _normalize(q, eps)
+    return np.sum(p * np.log(p / q), axis=-1)
+
+
+def js_divergence(p, q, eps=1e-12):
+    """
+    Jensen-Shannon divergence between p and q, computed along the last axis. Bounded by log(2).
+    :param p: first distribution(s). Need not be normalized.
+    :param q: second distribution(s). Need not be normalized.
+    :param eps: small value added to every bin to keep the logarithm finite.
+    :return: the divergence (scalar or array).
+    """
+    p = _normalize(p, eps)
+    q = _normalize(q, eps)
+    m = 0.5 * (p + q)
+    return 0.5 * np.sum(p * np.log(p / m), axis=-1) + 0.5 * np.sum(q * np.log(q / m), axis=-1)
+
+
+class ConvergenceMonitor:
+    """
+    Compares the ensemble's sampled histograms (summed over members) with the target distributions in a MultiPair.
+    Each poll appends one record to the history and, optionally, one line per pair to a tab-separated log:
+        time    pair    kl    js    samples
+    where the pair 'ensemble' holds the average over all pairs.
+    """
+
+    def __init__(self, ensemble_dir, pairs, members=None, output=None):
+        """
+        :param ensemble_dir: path to top directory which contains the full ensemble.
+        :param pairs: MultiPair object holding the target distributions.
+        :param members: list of ensemble numbers to monitor. If None, members are discovered on every poll.
+        :param output: path to the time series log. If None, the time series is only kept in memory.
+        """
+        self.ens_dir = ensemble_dir
+        self.members = members
+        self.output = output
+        self.history = []
+
+        self._targets = {}
+        for pd in pairs:
+            self._targets[pd.name] = _normalize(pd.get('distribution'), 0)
+        self._readers = {}
+        self._start = time.time()
+        self._thread = None
+        self._stop = threading.Event()
+
+    def __reader(self, member, name):
+        key = (member, name)
+        if key not in self._readers:
+            member_dir = DirectoryHelper(top_dir=self.ens_dir, ensemble_num=member).get_dir('ensemble_num')
+            self._readers[key] = CountsFile(os.path.join(member_dir, counts_filename(name)))
+        return self._readers[key]
+
+    def poll(self):
+        """
+        Read whatever has changed since the last poll and compute the divergences.
+        :return: record of the form {'time', 'kl', 'js', 'pairs': {name: {'kl', 'js', 'samples'}}}.
+        """
+        members = self.members
+        if members is None:
+            members = DirectoryHelper.list_members(self.ens_dir) if os.path.isdir(self.ens_dir) else []
+
+        record = {'time': time.time() - self._start, 'pairs': {}}
+        for name, target in self._targets.items():
+            sampled = np.zeros(len(target))
+            for member in members:
+                reader = self.__reader(member, name)
+                reader.poll()
+                if reader.counts is not None and len(reader.counts) == len(target):
+                    sampled += reader.counts
+            samples = int(np.sum(sampled))
+            if samples:
+                kl, js = float(kl_divergence(target, sampled)), float(js_divergence(target, sampled))
+            else:
+                kl, js = np.nan, np.nan
+            record['pairs'][name] = {'kl': kl, 'js': js, 'samples': samples}
+
+        kls = [values['kl'] for values in record['pairs'].values()]
+        jss = [values['js'] for values in record['pairs'].values()]
+        record['kl'] = float(np.mean(kls)) if kls else np.nan
+        record['js'] = float(np.mean(jss)) if jss else np.nan
+
+        self.history.append(record)
+        if self.output:
+            self.__write(record)
+        return record
+
+    def __write(self, record):
+        new_file = not os.path.exists(self.output)
+        with open(self.output, 'a') as f:
+            if new_file:
+                f.write('# time\tpair\tkl\tjs\tsamples\n')
+            line = '{:.1f}\t{}\t{:.6g}\t{:.6g}\t{}\n'
+            for name, values in record['pairs'].items():
+                f.write(line.format(record['time'], name, values['kl'], values['js'], values['samples']))
+            samples = sum(values['samples'] for values in record['pairs'].values())
+            f.write(line.format(record['time'], 'ensemble', record['kl'], record['js'], samples))
+
+    def is_converged(self, tolerance, window=3, metric='js'):
+        """
+        An ensemble is considered converged once the ensemble-wide divergence has stayed below the tolerance for the
+        last `window` polls.
+        :param tolerance: divergence threshold.
+        :param window: number of consecutive polls that must satisfy the threshold.
+        :param metric: 'js' or 'kl'.
+        :return: bool
+        """
+        if metric not in ['js', 'kl']:
+            raise ValueError('{} is not a valid divergence metric; use js or kl'.format(metric))
+        if len(self.history) < window:
+            return False
+        return all(record[metric] < tolerance for record in self.history[-window:])
+
+    def start(self, interval=60.):
+        """
+        Poll in a background thread every `interval` seconds until stop() is called.
+        :param interval: time between polls in seconds.
+        """
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+
+        def loop():
+            while not self._stop.is_set():
+                self.poll()
+                self._stop.wait(interval)
+
+        self._thread = threading.Thread(target=loop, name='EBMetaD-convergence', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
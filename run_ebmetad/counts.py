@@ -0,0 +1,106 @@
+"""
+Readers for the historical distance count files (counts_{name}.log) written by each ensemble member.
+"""
+
+import os
+import numpy as np
+
+
+def counts_filename(name):
+    """
+    Name of the historical distance count file for a pair. This is the same name that RunData stores as
+    'historical_data_filename'.
+    :param name: pair name.
+    :return: file name (relative to the ensemble member directory).
+    """
+    return 'counts_{}.log'.format(name)
+
+
+def parse_counts(text):
+    """
+    Parse the contents of a counts file. Files may contain either a single histogram (one row, or one value per line)
+    or a series of appended histograms (one row per snapshot); in the latter case the last row is returned.
+    :param text: file contents.
+    :return: 1D integer array of distance counts.
+    """
+    rows = [line.split() for line in text.splitlines() if line.strip()]
+    if not rows:
+        return np.zeros(0, dtype=np.int64)
+    if all(len(row) == 1 for row in rows):
+        return np.array([row[0] for row in rows], dtype=float).astype(np.int64)
+    return np.array(rows[-1], dtype=float).astype(np.int64)
+
+
+def read_counts(fnm):
+    """
+    Read a counts file in full.
+    :param fnm: path to the counts file.
+    :return: 1D integer array of distance counts.
+    """
+    with open(fnm, 'r') as f:
+        return parse_counts(f.read())
+
+
+def file_signature(fnm):
+    """
+    Cheap signature used to decide whether a file has changed since it was last read.
+    :param fnm: path to the file.
+    :return: (inode, size, mtime in ns), or None if the file does not exist.
+    """
+    try:
+        st = os.stat(fnm)
+    except FileNotFoundError:
+        return None
+    return st.st_ino, st.st_size, st.st_mtime_ns
+
+
+class CountsFile:
+    """
+    Change-driven reader for a single counts file.
+    The file is only read when its signature changes. Files of appended snapshot rows are tailed: if the file has grown
+    and the appended bytes hold complete rows, only those bytes are read. Single-histogram files (one value per line,
+    as written by np.savetxt) are rewritten in place on every update, so any value may change; they, like truncated or
+    replaced files, are read again in full.
+    """
+
+    def __init__(self, fnm):
+        self.fnm = fnm
+        self._signature = None
+        self._offset = 0
+        self._counts = None
+
+    @property
+    def counts(self):
+        return self._counts
+
+    def poll(self):
+        """
+        Bring the cached histogram up to date.
+        :return: True if the histogram changed, False otherwise.
+        """
+        signature = file_signature(self.fnm)
+        if signature is None or signature == self._signature:
+            return False
+
+        old_signature = self._signature
+        self._signature = signature
+        inode, size, _ = signature
+
+        if (old_signature is not None and self._counts is not None and inode == old_signature[0]
+                and size > self._offset > 0):
+            with open(self.fnm, 'rb') as f:
+                f.seek(self._offset - 1)
+                appended = f.read()
+            # The byte before the old offset must still end a line, otherwise the file has been rewritten
+            tail = appended[1:appended.rfind(b'\n') + 1] if appended[:1] == b'\n' else b''
+            rows = [line.split() for line in tail.splitlines() if line.strip()]
+            if rows and all(len(row) == len(self._counts) > 1 for row in rows):
+                self._counts = np.array(rows[-1], dtype=float).astype(np.int64)
+                self._offset += len(tail)
+                return True
+
+        with open(self.fnm, 'rb') as f:
+            text = f.read()
+        self._counts = parse_counts(text.decode())
+        self._offset = text.rfind(b'\n') + 1
+        return True
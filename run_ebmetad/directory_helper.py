@@ -14,26 +14,136 @@ How the directory structure is organized:
     ├── gromacs files
     └── force table
 
+
+Optionally, a member can be staged on node-local scratch: its directory is copied to
+scratch_dir/mem_{n}, the run happens there, and changed files are copied back to the
+top directory in a background thread (see ScratchSync).
 """
 
+import atexit
 import os
+import shutil
+import stat
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from run_ebmetad.counts import file_signature
+
+
+class ScratchSync:
+    """
+    Delta-only, one-way mirror of a directory tree. Each pass copies the files whose signature (inode, size, mtime)
+    changed since the previous pass; every copy goes through a temporary file and os.replace, so readers of the
+    destination never see a partially written file.
+    """
+
+    def __init__(self, src, dst, interval=60.):
+        """
+        :param src: directory to copy from.
+        :param dst: directory to copy to. Created if needed.
+        :param interval: time between background passes in seconds (see start).
+        """
+        self.src = src
+        self.dst = dst
+        self.interval = interval
+        self._signatures = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __walk(self):
+        for root, _, files in os.walk(self.src):
+            for fnm in files:
+                path = os.path.join(root, fnm)
+                yield os.path.relpath(path, self.src), file_signature(path)
+
+    def prime(self):
+        """
+        Record the current state of the source without copying anything, e.g. right after staging it in.
+        """
+        with self._lock:
+            self._signatures = {rel: signature for rel, signature in self.__walk() if signature is not None}
+
+    def sync(self):
+        """
+        Copy every file that changed since the last pass.
+        :return: list of copied paths, relative to the source.
+        """
+        copied = []
+        with self._lock:
+            for rel, signature in self.__walk():
+                if signature is None or self._signatures.get(rel) == signature:
+                    continue
+                target = os.path.join(self.dst, rel)
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                tmp = '{}.sync-tmp'.format(target)
+                try:
+                    shutil.copy2(os.path.join(self.src, rel), tmp)
+                except FileNotFoundError:
+                    # Removed while we were walking the tree
+                    continue
+                os.replace(tmp, target)
+                self._signatures[rel] = signature
+                copied.append(rel)
+        return copied
+
+    def request(self):
+        """
+        Ask the background thread for a pass now, without waiting for it.
+        """
+        self._wake.set()
+
+    def start(self):
+        """
+        Sync every `interval` seconds (or on request) in a background thread until stop() is called. A final pass is
+        made at interpreter exit.
+        """
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+
+        def loop():
+            while not self._stop.is_set():
+                self._wake.wait(self.interval)
+                self._wake.clear()
+                if not self._stop.is_set():
+                    self.sync()
+
+        self._thread = threading.Thread(target=loop, name='EBMetaD-scratch-sync', daemon=True)
+        self._thread.start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        """
+        Stop the background thread and make a final, blocking pass.
+        :return: list of paths copied by the final pass.
+        """
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+            atexit.unregister(self.stop)
+        return self.sync()
 
 
 class DirectoryHelper:
-    def __init__(self, top_dir, ensemble_num):
+    def __init__(self, top_dir, ensemble_num, scratch_dir=None):
         """
         Small class for manipulating a standard directory structure for EBMetaD runs.
         :param top_dir: the path to the directory containing all the ensemble members.
         :param param_dict: a dictionary specifying the ensemble number, the iteration,
         and the phase of the simulation.
+        :param scratch_dir: optional node-local directory in which the member is staged (see stage).
         """
         self._top_dir = top_dir
         self._ensemble_num = ensemble_num
+        self._scratch_dir = scratch_dir
 
     def get_dir(self, level):
         """
         Get the directory for however far you want to go down the directory tree
-        :param level: one of 'top' or 'ensemble_num'
+        :param level: one of 'top', 'ensemble_num' or 'scratch' (the staged copy of the ensemble member)
         See the directory structure example provided at the beginning of this class.
         :return: the path to the specified directory 'level' as a str.
         """
@@ -41,6 +151,8 @@ class DirectoryHelper:
             return_dir = self._top_dir
         elif level == 'ensemble_num':
             return_dir = '{}/mem_{}'.format(self._top_dir, self._ensemble_num)
+        elif level == 'scratch' and self._scratch_dir is not None:
+            return_dir = '{}/mem_{}'.format(self._scratch_dir, self._ensemble_num)
         else:
             raise ValueError(
                 '{} is not a valid directory type for BRER simulations'.format(
@@ -52,8 +164,123 @@ class DirectoryHelper:
         Checks to see if the working directory for current state of EBMetaD simulation exists.
         If it does not, creates the directory.
         """
-        if not os.path.exists(self.get_dir('ensemble_num')):
-            os.mkdir(self.get_dir('ensemble_num'))
+        os.makedirs(self.get_dir('ensemble_num'), exist_ok=True)
 
     def change_dir(self, level):
         os.chdir(self.get_dir(level))
+
+    def stage(self, sync_interval=60.):
+        """
+        Copy the ensemble member directory to node-local scratch, and start syncing changes back in the background.
+        :param sync_interval: time between sync-back passes in seconds.
+        :return: the running ScratchSync (scratch -> ensemble member directory); call stop() on it to make the final
+        pass, which otherwise happens at interpreter exit.
+        """
+        if self._scratch_dir is None:
+            raise ValueError('No scratch directory was given for ensemble member {}'.format(self._ensemble_num))
+        self.build_working_dir()
+        os.makedirs(self.get_dir('scratch'), exist_ok=True)
+        ScratchSync(self.get_dir('ensemble_num'), self.get_dir('scratch')).sync()
+
+        sync_back = ScratchSync(self.get_dir('scratch'), self.get_dir('ensemble_num'), interval=sync_interval)
+        sync_back.prime()
+        sync_back.start()
+        return sync_back
+
+    @staticmethod
+    def list_members(top_dir):
+        """
+        Find the ensemble members that have a working directory under the top directory.
+        :param top_dir: the path to the directory containing all the ensemble members.
+        :return: sorted list of ensemble numbers.
+        """
+        members = []
+        for entry in os.listdir(top_dir):
+            if entry.startswith('mem_') and entry[4:].isdigit() and os.path.isdir(os.path.join(top_dir, entry)):
+                members.append(int(entry[4:]))
+        return sorted(members)
+
+
+def _link(src, dst, link):
+    # Hard links fall back to symbolic links across filesystems
+    if os.path.lexists(dst):
+        if os.path.exists(dst) and os.path.samefile(src, dst):
+            return
+        os.remove(dst)
+    if link == 'hard':
+        try:
+            os.link(src, dst)
+            return
+        except OSError:
+            pass
+    os.symlink(os.path.relpath(src, os.path.dirname(dst)), dst)
+
+
+def check_ensemble(top_dir, members, names, max_workers=None):
+    """
+    Check, in parallel, that every member directory links to the shared copy of every input.
+    :param top_dir: the path to the directory containing all the ensemble members.
+    :param members: list of ensemble numbers.
+    :param names: file names of the shared inputs (in top_dir).
+    :param max_workers: size of the thread pool.
+    :return: dictionary of ensemble number -> list of missing or mismatched inputs, for the members with problems.
+    """
+    def check(member):
+        member_dir = DirectoryHelper(top_dir=top_dir, ensemble_num=member).get_dir('ensemble_num')
+        problems = []
+        for name in names:
+            path = os.path.join(member_dir, name)
+            if not os.path.exists(path) or not os.path.samefile(path, os.path.join(top_dir, name)):
+                problems.append(name)
+        return member, problems
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return {member: problems for member, problems in executor.map(check, members) if problems}
+
+
+def provision_ensemble(top_dir, members, shared_inputs=(), link='hard', max_workers=None):
+    """
+    Create the working directories of a whole ensemble at once. Each shared input (tpr, pair data, precomputed
+    tables, ...) is placed once in the top directory and linked into every member directory, instead of being copied
+    per member.
+    :param top_dir: the path to the directory containing all the ensemble members. Created if needed.
+    :param members: list of ensemble numbers, or the number of members.
+    :param shared_inputs: paths of read-only input files. Files that are not already in top_dir are copied there, and
+    the shared copies are made read-only.
+    :param link: 'hard' (falls back to a symbolic link across filesystems) or 'symlink'.
+    :param max_workers: size of the thread pool used for the integrity check.
+    :return: list of the member directories.
+    """
+    if link not in ['hard', 'symlink']:
+        raise ValueError('{} is not a valid link type; use hard or symlink'.format(link))
+    if isinstance(members, int):
+        members = range(members)
+    members = list(members)
+    os.makedirs(top_dir, exist_ok=True)
+
+    names = []
+    for fnm in shared_inputs:
+        name = os.path.basename(fnm)
+        shared = os.path.join(top_dir, name)
+        if not os.path.exists(shared) or not os.path.samefile(fnm, shared):
+            if os.path.exists(shared):
+                os.remove(shared)
+            shutil.copy2(fnm, shared)
+        # Every member links to this one file, so a member writing to it would corrupt the whole ensemble
+        mode = os.stat(shared).st_mode
+        os.chmod(shared, mode & ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH))
+        names.append(name)
+
+    member_dirs = []
+    for member in members:
+        dir_help = DirectoryHelper(top_dir=top_dir, ensemble_num=member)
+        dir_help.build_working_dir()
+        member_dir = dir_help.get_dir('ensemble_num')
+        for name in names:
+            _link(os.path.join(top_dir, name), os.path.join(member_dir, name), link)
+        member_dirs.append(member_dir)
+
+    problems = check_ensemble(top_dir, members, names, max_workers=max_workers)
+    if problems:
+        raise ValueError('Provisioning failed for ensemble members {}'.format(problems))
+    return member_dirs
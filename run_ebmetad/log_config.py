@@ -0,0 +1,73 @@
+"""
+Non-blocking logging for EBMetaD ensemble members.
+Each member logs to its own child of the 'EBMetaD' logger through a QueueHandler; a QueueListener thread does the
+actual (blocking) writes to the member's log file and to the console, so setup and run threads never wait on disk.
+"""
+
+import atexit
+import logging
+import logging.handlers
+import queue
+
+FORMAT = '%(asctime)s:%(name)s:%(levelname)s - %(message)s'
+
+# ensemble number -> (logger, QueueListener)
+_members = {}
+
+
+def member_logger(ensemble_num, log_level=logging.DEBUG, filename=None, console=True):
+    """
+    Get the logger of an ensemble member, installing its queue handler and listener on first use. Calling this again
+    for the same member only updates the log level, so handlers are never duplicated.
+    :param ensemble_num: the ensemble member.
+    :param log_level: level name or number, e.g. 'INFO' or logging.DEBUG.
+    :param filename: log file; defaults to ebmetad{ensemble_num}.log in the current directory.
+    :param console: if True, also log to the console.
+    :return: logging.Logger
+    """
+    if ensemble_num in _members:
+        logger = _members[ensemble_num][0]
+        logger.setLevel(log_level)
+        return logger
+
+    formatter = logging.Formatter(FORMAT)
+    handlers = [logging.FileHandler(filename or 'ebmetad{}.log'.format(ensemble_num))]
+    if console:
+        handlers.append(logging.StreamHandler())
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    records = queue.Queue(-1)
+    listener = logging.handlers.QueueListener(records, *handlers)
+    listener.start()
+
+    logger = logging.getLogger('EBMetaD.mem_{}'.format(ensemble_num))
+    logger.setLevel(log_level)
+    logger.addHandler(logging.handlers.QueueHandler(records))
+    # The listener already writes to the console; propagating would print every record again through any root
+    # handlers (e.g. logging.basicConfig)
+    logger.propagate = False
+    _members[ensemble_num] = (logger, listener)
+    return logger
+
+
+def stop_logging(ensemble_num=None):
+    """
+    Flush and remove the queue handlers of one member, or of every member.
+    :param ensemble_num: the ensemble member; None stops all of them.
+    """
+    members = list(_members) if ensemble_num is None else [ensemble_num]
+    for member in members:
+        if member not in _members:
+            continue
+        logger, listener = _members.pop(member)
+        for handler in list(logger.handlers):
+            if isinstance(handler, logging.handlers.QueueHandler):
+                logger.removeHandler(handler)
+        # stop() processes the records still in the queue before returning
+        listener.stop()
+        for handler in listener.handlers:
+            handler.close()
+
+
+atexit.register(stop_logging)
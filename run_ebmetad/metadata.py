@@ -2,7 +2,124 @@
 Abstract class for handling all BRER metadata. State and PairData classes inherit from this class.
 """
 from abc import ABC
+import hashlib
 import json
+import numpy as np
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Serializer used for all metadata I/O: orjson when it is installed (it also writes numpy arrays natively),
+# otherwise the standard library. Both write floats with float64 precision, so files do not depend on the backend.
+_json_backend = 'orjson' if orjson is not None else 'json'
+
+
+def set_json_backend(name):
+    """
+    Choose the json library used for metadata I/O.
+    :param name: 'orjson' or 'json'.
+    """
+    global _json_backend
+    if name == 'orjson' and orjson is None:
+        raise ImportError('orjson is not installed')
+    if name not in ['orjson', 'json']:
+        raise ValueError('{} is not a supported json backend'.format(name))
+    _json_backend = name
+
+
+def get_json_backend():
+    return _json_backend
+
+
+def to_serializable(obj):
+    """
+    json default hook: stores numpy arrays (e.g., force tables built in batches) as nested lists.
+    """
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    raise TypeError('{} is not JSON serializable'.format(type(obj).__name__))
+
+
+def _widen(obj):
+    """
+    Copy of obj with float32 arrays and scalars as float64, so that orjson writes them with the same precision as the
+    standard library (which goes through Python floats).
+    """
+    if isinstance(obj, dict):
+        return {key: _widen(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [_widen(value) for value in obj]
+    if isinstance(obj, np.ndarray) and obj.dtype == np.float32:
+        return obj.astype(np.float64)
+    if isinstance(obj, np.float32):
+        return float(obj)
+    return obj
+
+
+def dumps_json(data, indent=None):
+    """
+    Serialize to a json string with the selected backend.
+    :param data: data to serialize. May contain numpy arrays.
+    :param indent: indent the output (orjson only supports an indent of 2).
+    :return: str
+    """
+    if _json_backend == 'orjson':
+        option = orjson.OPT_SERIALIZE_NUMPY | (orjson.OPT_INDENT_2 if indent else 0)
+        return orjson.dumps(_widen(data), default=to_serializable, option=option).decode()
+    return json.dumps(data, default=to_serializable, indent=indent)
+
+
+def loads_json(text):
+    if _json_backend == 'orjson':
+        return orjson.loads(text)
+    return json.loads(text)
+
+
+def dump_json(data, filename, indent=None):
+    """
+    Write data to a json file with the selected backend.
+    :param data: data to serialize. May contain numpy arrays.
+    :param filename: output path.
+    :param indent: indent the output (orjson only supports an indent of 2).
+    """
+    if _json_backend == 'orjson':
+        option = orjson.OPT_SERIALIZE_NUMPY | (orjson.OPT_INDENT_2 if indent else 0)
+        with open(filename, 'wb') as f:
+            f.write(orjson.dumps(_widen(data), default=to_serializable, option=option))
+    else:
+        with open(filename, 'w') as f:
+            json.dump(data, f, default=to_serializable, indent=indent)
+
+
+def load_json(filename):
+    """
+    Read a json file with the selected backend.
+    :param filename: path to the file.
+    :return: the parsed data.
+    """
+    if _json_backend == 'orjson':
+        with open(filename, 'rb') as f:
+            return orjson.loads(f.read())
+    with open(filename, 'r') as f:
+        return json.load(f)
+
+
+def file_fingerprint(filename, chunk_size=2**20):
+    """
+    Content hash of a file, used to check that saved configurations were built from the same inputs.
+    :param filename: path to the file.
+    :param chunk_size: number of bytes read at a time.
+    :return: hex digest.
+    """
+    sha = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
 
 
 class MetaData(ABC):
@@ -14,6 +131,10 @@ class MetaData(ABC):
         """
         self.__name = name
         self.__required_parameters = []
+        # Requirements are also kept as a frozen set for O(1) membership tests, and completeness is cached
+        # (it can only be lost by replacing the whole dictionary or the requirements).
+        self.__required_set = frozenset()
+        self.__complete = False
         self._metadata = {}
 
     @property
@@ -26,28 +147,50 @@ class MetaData(ABC):
 
     def set_requirements(self, list_of_requirements: list):
         self.__required_parameters = list_of_requirements
+        self.__required_set = frozenset(list_of_requirements)
+        self.__complete = False
 
     def get_requirements(self):
         return self.__required_parameters
 
+    def get_requirement_set(self):
+        return self.__required_set
+
+    def is_required(self, key):
+        return key in self.__required_set
+
     def set(self, key, value):
         self._metadata[key] = value
 
+    def update(self, **params):
+        """
+        Set several parameters at once. All keys are validated against the requirements before anything is set.
+        :param params: parameters and their values.
+        """
+        unknown = [key for key in params if key not in self.__required_set]
+        if unknown:
+            raise ValueError('{} are not parameters of {}'.format(unknown, self.name))
+        self._metadata.update(params)
+
     def get(self, key):
         return self._metadata[key]
 
     def set_from_dictionary(self, data):
         self._metadata = data
+        self.__complete = False
 
     def get_as_dictionary(self):
         return self._metadata
 
+    def is_complete(self):
+        if not self.__complete:
+            self.__complete = self.__required_set.issubset(self._metadata.keys())
+        return self.__complete
+
     def get_missing_keys(self):
-        missing = []
-        for required in self.__required_parameters:
-            if required not in self._metadata.keys():
-                missing.append(required)
-        return missing
+        if self.is_complete():
+            return []
+        return [required for required in self.__required_parameters if required not in self._metadata]
 
 
 class MultiMetaData(ABC):
@@ -90,13 +233,13 @@ class MultiMetaData(ABC):
         return single_dataset
 
     def write_to_json(self, filename='state.json'):
-        json.dump(self.get_as_single_dataset(), open(filename, 'w'))
+        dump_json(self.get_as_single_dataset(), filename)
 
     def read_from_json(self, filename='state.json'):
         # TODO: decide on expected behavior here if there's a pre-existing list of data. For now, overwrite
         self._metadata_list = []
         self._names = []
-        data = json.load(open(filename, 'r'))
+        data = load_json(filename)
         for name, metadata in data.items():
             self._names.append(name)
             metadata_obj = MetaData(name=name)
@@ -0,0 +1,196 @@
+"""
+MPI-distributed force-table sweeps and ensemble setup (requires mpi4py).
+Rank 0 parses the pair data once and broadcasts it; the work items ((w, sigma) combinations, or ensemble members) are
+dealt out round-robin across ranks, and the small per-item results are gathered on rank 0.
+
+Usage (locally, or inside an allocation):
+    mpirun -n 4 python force_table.py --mpi -f pair_data.json -w 0.1 1 10 -s 0.2 0.4 -o sweep
+    mpirun -n 4 python -m run_ebmetad.mpi --ensemble_dir ens --pairs_json pair_data.json -n 64 --shared topol.tpr
+
+Every function takes an optional communicator; SerialComm runs the same code in a single process without MPI.
+"""
+
+import argparse
+import os
+from run_ebmetad.directory_helper import DirectoryHelper, provision_ensemble
+from run_ebmetad.metadata import file_fingerprint, load_json
+from run_ebmetad.pair_data import MultiPair, read_sidecar, write_sidecar
+from run_ebmetad.run_data import RunData
+from run_ebmetad.sweep import combinations, sweep_combination, write_index
+
+try:
+    from mpi4py import MPI
+except ImportError:
+    MPI = None
+
+
+class SerialComm:
+    """
+    Single-process stand-in for an mpi4py communicator (the subset used in this module).
+    """
+    rank = 0
+    size = 1
+
+    def bcast(self, obj, root=0):
+        return obj
+
+    def gather(self, obj, root=0):
+        return [obj]
+
+    def barrier(self):
+        pass
+
+
+def get_comm(comm=None):
+    """
+    :param comm: communicator to use; defaults to MPI.COMM_WORLD.
+    :return: the communicator.
+    """
+    if comm is not None:
+        return comm
+    if MPI is None:
+        raise ImportError('mpi4py is not installed')
+    return MPI.COMM_WORLD
+
+
+def distribute(items, comm):
+    """
+    Round-robin share of the work items owned by this rank.
+    :param items: list of work items (the same on every rank).
+    :param comm: communicator.
+    :return: list of items for this rank.
+    """
+    return list(items)[comm.rank::comm.size]
+
+
+def broadcast_pairs(pairs_json, comm=None, cache=False):
+    """
+    Parse the pair data on rank 0 only and broadcast them to every rank.
+    :param pairs_json: path to the pair data.
+    :param comm: communicator.
+    :param cache: read through the binary sidecar cache (see MultiPair.read_from_json).
+    :return: MultiPair
+    """
+    comm = get_comm(comm)
+    data = None
+    if comm.rank == 0:
+        data = read_sidecar(pairs_json) if cache else None
+        if data is None:
+            data = load_json(pairs_json)
+            if cache:
+                write_sidecar(pairs_json, data)
+    multi_pair = MultiPair()
+    multi_pair.set_from_dictionary(comm.bcast(data, root=0))
+    return multi_pair
+
+
+def mpi_sweep(pairs_json, weights, sigmas, output_dir, comm=None, cache=False):
+    """
+    Distributed version of sweep.run_sweep: each rank writes the .npz files of its combinations, and rank 0 writes the
+    index.
+    :param pairs_json: path to the pair data.
+    :param weights: list of w values.
+    :param sigmas: list of sigma values.
+    :param output_dir: sweep output directory (on a filesystem shared by all ranks). Created if needed.
+    :param comm: communicator.
+    :param cache: read the pair data through the binary sidecar cache.
+    :return: the index, on every rank.
+    """
+    comm = get_comm(comm)
+    pairs_json = os.path.abspath(pairs_json)
+    multi_pair = broadcast_pairs(pairs_json, comm, cache)
+    if comm.rank == 0:
+        os.makedirs(output_dir, exist_ok=True)
+    comm.barrier()
+
+    mine = distribute(combinations(weights, sigmas), comm)
+    entries = [sweep_combination(multi_pair, output_dir, w, s) for w, s in mine]
+    gathered = comm.gather(entries, root=0)
+    index = None
+    if comm.rank == 0:
+        entries = [entry for rank_entries in gathered for entry in rank_entries]
+        index = write_index(output_dir, pairs_json, multi_pair.get_names(), entries, weights, sigmas)
+    return comm.bcast(index, root=0)
+
+
+def mpi_setup_ensemble(ensemble_dir, pairs_json, members, comm=None, general_params=None, shared_inputs=(),
+                       cache=False):
+    """
+    Prepare every ensemble member for a resumed RunConfig: rank 0 provisions the directories (see
+    provision_ensemble) and builds the force tables once; each rank then writes the run_config.json of its members.
+    RunConfig(..., general_params=general_params, resume=True) picks these files up without parsing the pair data or
+    building any table.
+    :param ensemble_dir: path to top directory which contains the full ensemble.
+    :param pairs_json: path to file containing *ALL* the pair metadata.
+    :param members: list of ensemble numbers, or the number of members.
+    :param comm: communicator.
+    :param general_params: optional dictionary of general parameters (w, sigma, k, rebin_ratio, ...).
+    :param shared_inputs: read-only files (tpr, ...) linked into every member directory.
+    :param cache: read the pair data through the binary sidecar cache.
+    :return: list of the ensemble numbers set up by this rank.
+    """
+    comm = get_comm(comm)
+    if isinstance(members, int):
+        members = range(members)
+    members = list(members)
+    general_params = general_params or {}
+    multi_pair = broadcast_pairs(pairs_json, comm, cache)
+
+    # The same run data serve every member; only the ensemble number differs
+    run_data = RunData()
+    run_data.set(**general_params)
+    for i, pd in enumerate(multi_pair):
+        resolved = run_data.from_pair_data(pd)
+        if resolved is not pd:
+            multi_pair[i] = resolved
+
+    w, sigma = run_data.get('w'), run_data.get('sigma')
+    force_tables = None
+    pairs_fingerprint = None
+    if comm.rank == 0:
+        provision_ensemble(ensemble_dir, members, shared_inputs=shared_inputs)
+        force_tables = multi_pair.build_force_tables(w, sigma)
+        pairs_fingerprint = file_fingerprint(pairs_json)
+    # Also keeps the other ranks from writing before the member directories exist
+    force_tables = comm.bcast(force_tables, root=0)
+    pairs_fingerprint = comm.bcast(pairs_fingerprint, root=0)
+    for name in multi_pair.get_names():
+        run_data.set(name=name, force_table=force_tables[name])
+
+    mine = distribute(members, comm)
+    for member in mine:
+        run_data.set(ensemble_num=member)
+        run_data.fingerprint = {
+            'pairs_json': pairs_fingerprint,
+            'ensemble_num': member,
+            'general_params': general_params,
+            'force_table_params': {'w': w, 'sigma': sigma, 'rebin_ratio': run_data.get('rebin_ratio')}
+        }
+        member_dir = DirectoryHelper(top_dir=ensemble_dir, ensemble_num=member).get_dir('ensemble_num')
+        run_data.save_config(os.path.join(member_dir, 'run_config.json'))
+    comm.barrier()
+    return mine
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser("Sets up an EBMetaD ensemble across MPI ranks")
+    parser.add_argument('--ensemble_dir', required=True, help="top directory which contains the full ensemble")
+    parser.add_argument('--pairs_json', required=True, help="path to the pair metadata")
+    parser.add_argument('-n', type=int, required=True, help="number of ensemble members")
+    parser.add_argument('-w', type=float, help="weight, or height, of Gaussians")
+    parser.add_argument('-s', type=float, help="sigma. Width of Gaussians")
+    parser.add_argument('--shared', nargs='*', default=[], help="read-only inputs linked into every member directory")
+    parser.add_argument('--cache', action='store_true', help="read the pair data through a binary sidecar cache")
+    args = parser.parse_args(argv)
+
+    general_params = {}
+    if args.w is not None:
+        general_params['w'] = args.w
+    if args.s is not None:
+        general_params['sigma'] = args.s
+    mpi_setup_ensemble(os.path.abspath(args.ensemble_dir), os.path.abspath(args.pairs_json), args.n,
+                       general_params=general_params, shared_inputs=args.shared, cache=args.cache)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,165 @@
+"""
+Runs a whole EBMetaD ensemble on one node: every member is launched as a subprocess, at most `max_concurrent` at a
+time, with its output streamed to the log. Failed members are restarted; since members are launched in resume mode,
+a restart continues from the member's saved run_config.json and counts files.
+
+Usage:
+    python -m run_ebmetad.orchestrator ensemble --tpr topol.tpr --ensemble_dir ens --pairs_json pairs.json -n 16
+    python -m run_ebmetad.orchestrator member --tpr topol.tpr --ensemble_dir ens --pairs_json pairs.json -m 3
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import sys
+import time
+from run_ebmetad.directory_helper import DirectoryHelper
+
+
+class EnsembleOrchestrator:
+    def __init__(self, tpr, ensemble_dir, pairs_json, members, nsteps=None, max_concurrent=None, max_restarts=2,
+                 command=None):
+        """
+        :param tpr: path to tpr.
+        :param ensemble_dir: path to top directory which contains the full ensemble.
+        :param pairs_json: path to file containing *ALL* the pair metadata.
+        :param members: list of ensemble numbers to run.
+        :param nsteps: number of MD steps per member (None runs the tpr as is).
+        :param max_concurrent: maximum number of members running at once; defaults to the number of cores.
+        :param max_restarts: number of times a failed member is relaunched.
+        :param command: optional callable (member, attempt) -> argv used instead of the default member command, e.g. to
+        launch a stand-in engine.
+        """
+        # Members are launched from their own directories, so every path is made absolute
+        self.tpr = os.path.abspath(tpr)
+        self.ens_dir = os.path.abspath(ensemble_dir)
+        self.pairs_json = os.path.abspath(pairs_json)
+        self.members = list(members)
+        self.nsteps = nsteps
+        self.max_concurrent = max_concurrent or os.cpu_count() or 1
+        self.max_restarts = max_restarts
+        self.command = command or self.member_command
+        self.results = {}
+        self._logger = logging.getLogger('EBMetaD.orchestrator')
+
+    def member_command(self, member, attempt):
+        """
+        Default command: run one member through this module's 'member' entry point in resume mode.
+        :param member: ensemble number.
+        :param attempt: 0 for the first launch, 1, 2, ... for restarts.
+        :return: argv list.
+        """
+        argv = [
+            sys.executable, '-m', 'run_ebmetad.orchestrator', 'member', '--tpr', self.tpr, '--ensemble_dir',
+            self.ens_dir, '--pairs_json', self.pairs_json, '-m',
+            str(member)
+        ]
+        if self.nsteps:
+            argv.extend(['--nsteps', str(self.nsteps)])
+        return argv
+
+    async def __stream(self, member, stream, log_file):
+        with open(log_file, 'a') as f:
+            while True:
+                line = await stream.readline()
+                if not line:
+                    break
+                text = line.decode(errors='replace').rstrip()
+                f.write(text + '\n')
+                self._logger.info('[mem_{}] {}'.format(member, text))
+
+    async def __run_member(self, member, semaphore):
+        dir_help = DirectoryHelper(top_dir=self.ens_dir, ensemble_num=member)
+        dir_help.build_working_dir()
+        log_file = os.path.join(dir_help.get_dir('ensemble_num'), 'orchestrator.log')
+
+        async with semaphore:
+            start = time.time()
+            returncode = None
+            for attempt in range(self.max_restarts + 1):
+                if attempt:
+                    self._logger.warning('Restarting mem_{} (attempt {}) after exit code {}'.format(
+                        member, attempt + 1, returncode))
+                attempt_start = time.time()
+                # Members run in their own directory, where RunConfig keeps run_config.json and the counts files
+                process = await asyncio.create_subprocess_exec(*self.command(member, attempt),
+                                                               stdout=asyncio.subprocess.PIPE,
+                                                               stderr=asyncio.subprocess.STDOUT,
+                                                               cwd=dir_help.get_dir('ensemble_num'))
+                await self.__stream(member, process.stdout, log_file)
+                returncode = await process.wait()
+                if returncode == 0:
+                    break
+            attempt_time = time.time() - attempt_start
+            wall_time = time.time() - start
+
+        # The throughput is that of the successful attempt; failed attempts only count towards the wall time
+        result = {
+            'member': member,
+            'returncode': returncode,
+            'attempts': attempt + 1,
+            'wall_time': wall_time,
+            'steps_per_second': self.nsteps / attempt_time if self.nsteps and returncode == 0 else None
+        }
+        self.results[member] = result
+        self._logger.info('mem_{} finished: {}'.format(member, result))
+        return result
+
+    async def run_async(self):
+        semaphore = asyncio.Semaphore(self.max_concurrent)
+        return await asyncio.gather(*[self.__run_member(member, semaphore) for member in self.members])
+
+    def run(self):
+        """
+        Run every member to completion.
+        :return: list of per-member results (exit code, attempts, wall time and throughput).
+        """
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(self.run_async())
+        finally:
+            loop.close()
+
+
+def run_member(args):
+    # Imported here so that the orchestrator itself does not need gmxapi
+    from run_ebmetad.run_config import RunConfig
+
+    config = RunConfig(tpr=args.tpr, ensemble_dir=args.ensemble_dir, ensemble_num=args.m, pairs_json=args.pairs_json,
+                       resume=True, log_level=args.log_level)
+    config.run(nsteps=args.nsteps)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser("Runs EBMetaD ensemble members as subprocesses")
+    parser.add_argument('mode', choices=['ensemble', 'member'], help="launch a whole ensemble, or run one member")
+    parser.add_argument('--tpr', required=True, help="path to tpr")
+    parser.add_argument('--ensemble_dir', required=True, help="top directory which contains the full ensemble")
+    parser.add_argument('--pairs_json', required=True, help="path to the pair metadata")
+    parser.add_argument('--nsteps', type=int, help="number of MD steps per member")
+    parser.add_argument('-m', type=int, help="ensemble number (member mode)")
+    parser.add_argument('-n', type=int, help="number of ensemble members (ensemble mode)")
+    parser.add_argument('-j', type=int, help="maximum number of concurrent members (default: number of cores)")
+    parser.add_argument('--max_restarts', type=int, default=2, help="restarts per failed member")
+    parser.add_argument('--log_level', default='DEBUG', help="log level of the member logs (member mode)")
+    args = parser.parse_args(argv)
+
+    if args.mode == 'member':
+        if args.m is None:
+            parser.error('member mode requires -m')
+        run_member(args)
+        return 0
+    if args.n is None:
+        parser.error('ensemble mode requires -n')
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s:%(name)s:%(levelname)s - %(message)s')
+    orchestrator = EnsembleOrchestrator(os.path.abspath(args.tpr), os.path.abspath(args.ensemble_dir),
+                                        os.path.abspath(args.pairs_json), range(args.n), nsteps=args.nsteps,
+                                        max_concurrent=args.j, max_restarts=args.max_restarts)
+    results = orchestrator.run()
+    return 0 if all(result['returncode'] == 0 for result in results) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -3,8 +3,13 @@ Classes to handle pair metadata
 """
 
 import numpy as np
-from run_ebmetad.metadata import MetaData, MultiMetaData
+from run_ebmetad.metadata import MetaData, MultiMetaData, dumps_json, load_json, loads_json
+from run_ebmetad.bins import BinIndex, bin_edges
+from run_ebmetad.bias import BiasEvaluator, integrate_force_table
+import hashlib
 import json
+import os
+import tempfile
 
 
 def entropy(probs):
@@ -15,48 +20,355 @@ def entropy(probs):
     return S
 
 
+def bins_fingerprint(bins):
+    """
+    Content hash of a bin grid, used to recognize pairs that share the same grid.
+    :param bins: distance bins.
+    :return: hex digest.
+    """
+    return hashlib.sha1(np.ascontiguousarray(bins, dtype=np.float64).tobytes()).hexdigest()
+
+
+def pair_fingerprint(pd):
+    """
+    Content hash of the inputs of a pair's force table (distribution and bins). Together with w and sigma, this fully
+    determines the table, so pairs with the same fingerprint can share one.
+    :param pd: PairData object.
+    :return: hex digest.
+    """
+    sha = hashlib.sha1()
+    sha.update(np.ascontiguousarray(pd.get('distribution'), dtype=np.float64).tobytes())
+    sha.update(np.ascontiguousarray(pd.get('bins'), dtype=np.float64).tobytes())
+    return sha.hexdigest()
+
+
+def build_kernel(bins, sigma):
+    """
+    The part of the force table that depends only on the bin grid and sigma:
+    K[i, j] = exp(-(d_i - d_j)^2 / 2 sigma^2) * (1 - d_j / d_i), with K = 0 wherever d_i or d_j is zero.
+    :param bins: distance bins.
+    :param sigma: width of the Gaussians.
+    :return: (nbins, nbins) float64 array.
+    """
+    return build_kernel_rows(bins, sigma, 0, len(bins))
+
+
+# Number of (rows x nbins) float64 arrays alive at once while build_kernel_rows runs
+KERNEL_TEMPORARIES = 2
+
+
+def kernel_block_rows(nbins, max_memory):
+    """
+    :param nbins: number of bins.
+    :param max_memory: memory budget for the kernel temporaries, in bytes.
+    :return: number of kernel rows that can be built at once within max_memory (at least one).
+    """
+    return max(1, int(max_memory // (KERNEL_TEMPORARIES * 8 * nbins)))
+
+
+def build_kernel_rows(bins, sigma, start, stop):
+    """
+    Rows start:stop of the kernel returned by build_kernel.
+    :param bins: distance bins.
+    :param sigma: width of the Gaussians.
+    :param start: first row (current distance index).
+    :param stop: one past the last row.
+    :return: (stop - start, nbins) float64 array.
+    """
+    dists = np.asarray(bins, dtype=np.float64)
+    rows = dists[start:stop]
+    # Computed in place, so only KERNEL_TEMPORARIES (rows x nbins) float64 arrays are allocated, the kernel included
+    kernel = np.subtract(rows[:, None], dists[None, :])
+    np.square(kernel, out=kernel)
+    np.negative(kernel, out=kernel)
+    kernel /= sigma**2
+    kernel /= 2
+    np.exp(kernel, out=kernel)
+    # The distance better not ever be zero, but if it is, the restraint contributes nothing for that bin
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratio = np.divide(dists[None, :], rows[:, None])
+        np.subtract(1., ratio, out=ratio)
+        kernel *= ratio
+    del ratio
+    kernel[rows == 0, :] = 0
+    kernel[:, dists == 0] = 0
+    return kernel
+
+
+class KernelCache:
+    """
+    Cache of force-table kernels keyed by (bins fingerprint, sigma), so that pairs on the same grid share one kernel.
+    """
+
+    def __init__(self):
+        self._kernels = {}
+
+    def get(self, bins, sigma):
+        key = (bins_fingerprint(bins), float(sigma))
+        if key not in self._kernels:
+            self._kernels[key] = build_kernel(bins, sigma)
+        return self._kernels[key]
+
+    def clear(self):
+        self._kernels = {}
+
+    def __len__(self):
+        return len(self._kernels)
+
+
+def sidecar_filename(filename):
+    return '{}.cache.npz'.format(filename)
+
+
+def _sidecar_key(filename):
+    st = os.stat(filename)
+    return json.dumps([os.path.abspath(filename), st.st_size, st.st_mtime_ns])
+
+
+def read_sidecar(filename):
+    """
+    Read the parsed pair data from the binary sidecar of a pair data json, if the sidecar matches the json file's
+    path, size and mtime.
+    :param filename: path to the pair data json.
+    :return: the same dictionary json.load would return, or None if there is no valid sidecar.
+    """
+    try:
+        with np.load(sidecar_filename(filename)) as sidecar:
+            if str(sidecar['key']) != _sidecar_key(filename):
+                return None
+            index = loads_json(str(sidecar['index']))
+            distributions = np.split(sidecar['distributions'], sidecar['offsets'][1:-1])
+            bins = np.split(sidecar['bins'], sidecar['offsets'][1:-1])
+    except (OSError, KeyError, ValueError):
+        return None
+
+    data = {}
+    for i, (name, metadata) in enumerate(index):
+        metadata['distribution'] = distributions[i].tolist()
+        metadata['bins'] = bins[i].tolist()
+        data[name] = metadata
+    return data
+
+
+def write_sidecar(filename, data):
+    """
+    Write a binary sidecar for a pair data json: the distributions and bins as flat float64 arrays plus a small json
+    index of everything else. The file is written under a temporary name and renamed into place, so many ensemble
+    members racing to create the same sidecar never see a partial file.
+    :param filename: path to the pair data json.
+    :param data: the parsed pair data.
+    """
+    index, distributions, bins, offsets = [], [], [], [0]
+    for name, metadata in data.items():
+        if len(metadata['distribution']) != len(metadata['bins']):
+            return
+        index.append([name, {key: value for key, value in metadata.items() if key not in ['distribution', 'bins']}])
+        distributions.extend(metadata['distribution'])
+        bins.extend(metadata['bins'])
+        offsets.append(len(distributions))
+
+    # The cache is only an optimization, so a read-only data directory is not an error
+    try:
+        key = _sidecar_key(filename)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(filename)), suffix='.npz')
+    except OSError:
+        return
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, key=np.array(key), index=np.array(dumps_json(index)),
+                     distributions=np.array(distributions, dtype=np.float64), bins=np.array(bins, dtype=np.float64),
+                     offsets=np.array(offsets, dtype=np.int64))
+        os.replace(tmp, sidecar_filename(filename))
+    except OSError:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
 class PairData(MetaData):
     def __init__(self, name):
         super().__init__(name=name)
         self.set_requirements(['distribution', 'bins', 'sites'])
 
-    def build_force_table(self, w=10, sigma=0.2):
+    def prefactor(self, w=10, sigma=0.2):
+        """
+        Full force-table pre-factor, w / effective volume / sigma^2.
+        :param w: weight, or height, of the Gaussians.
+        :param sigma: width of the Gaussians.
+        :return: float
+        """
+        probs = self.get('distribution')
+        probs = np.divide(probs, np.sum(probs))  # Normalization, just in case
+        effective_volume = np.exp(entropy(probs))
+        return w / effective_volume / sigma**2
+
+    def bin_edges(self):
+        """
+        Edges of the distance bins: bin i covers [bins[i], bins[i + 1]); the last bin is as wide as the one before it.
+        :return: array of nbins + 1 edges.
+        """
+        return bin_edges(self.get('bins'))
+
+    def bin_index(self):
+        """
+        :return: BinIndex for vectorized distance -> bin lookups on this pair's (possibly non-uniform) grid.
+        """
+        return BinIndex(self.get('bins'))
+
+    def rebin(self, bin_width=None, bins=None):
+        """
+        Redistribute the probability mass onto a coarser (or non-uniform) grid. Each old bin's mass is shared among
+        the new bins in proportion to their overlap, so the total mass is conserved.
+        :param bin_width: width of a new uniform grid starting at the first bin.
+        :param bins: alternatively, the left edges of an arbitrary increasing grid.
+        :return: (new PairData, report). The report holds the number of bins and the float32 force-table size in
+        bytes before and after, and 'error': the total variation distance between the original distribution and the
+        rebinned one spread back onto the original grid.
+        """
+        old_edges = self.bin_edges()
+        if bins is None:
+            if not bin_width:
+                raise ValueError('Must provide either a bin width or a grid to rebin onto')
+            nbins = int(np.ceil(np.round((old_edges[-1] - old_edges[0]) / bin_width, 8)))
+            bins = old_edges[0] + bin_width * np.arange(nbins)
+        bins = np.round(np.asarray(bins, dtype=np.float64), 10)
+        if len(bins) < 2 or np.any(np.diff(bins) <= 0):
+            raise ValueError('The new bins must be strictly increasing')
+        new_edges = np.append(bins, max(old_edges[-1], bins[-1] + (bins[-1] - bins[-2])))
+        new_edges[0] = min(new_edges[0], old_edges[0])
 
+        # overlap[k, i]: length of new bin k that overlaps old bin i
+        upper = np.minimum(new_edges[1:, None], old_edges[None, 1:])
+        lower = np.maximum(new_edges[:-1, None], old_edges[None, :-1])
+        overlap = np.clip(upper - lower, 0, None)
+        probs = np.asarray(self.get('distribution'), dtype=np.float64)
+        new_probs = overlap.dot(probs / np.diff(old_edges))
+        restored = overlap.T.dot(new_probs / np.diff(new_edges))
+
+        rebinned = PairData(self.name)
+        rebinned.set_from_dictionary(dict(self.get_as_dictionary()))
+        rebinned.set('distribution', new_probs.tolist())
+        rebinned.set('bins', bins.tolist())
+
+        report = {
+            'nbins_before': len(probs),
+            'nbins_after': len(bins),
+            'table_bytes_before': 4 * len(probs)**2,
+            'table_bytes_after': 4 * len(bins)**2,
+            'error': 0.5 * float(np.sum(np.abs(probs - restored))) / float(np.sum(probs))
+        }
+        return rebinned, report
+
+    def build_force_table(self, w=10, sigma=0.2, kernel_cache=None):
+        """
+        Build the EBMetaD force table. Rows are current distances, columns are historical distances.
+        :param w: weight, or height, of the Gaussians.
+        :param sigma: width of the Gaussians.
+        :param kernel_cache: optional KernelCache shared between pairs on the same bin grid.
+        :return: force table as a nested list.
+        """
         dists = self.get('bins')
         probs = self.get('distribution')
-        nbins = len(probs)
 
-        force_table = np.zeros(shape=(nbins, nbins), dtype=np.float32)
-
-        # Calculate the effective volume pre-factor
         probs = np.divide(probs, np.sum(probs))  # Normalization, just in case
-        effective_volume = np.exp(entropy(probs))
+        pf = self.prefactor(w, sigma)
 
-        # Calculate the full pre-factor
-        pf = w / effective_volume / sigma**2
+        if kernel_cache is not None:
+            kernel = kernel_cache.get(dists, sigma)
+        else:
+            kernel = build_kernel(dists, sigma)
 
-        for i in range(nbins):  # Current distance
-            for j in range(nbins):  # Historical distances
-                exponent = -(dists[i] - dists[j])**2 / sigma**2 / 2
-                # add 1.0 to the probability so that we apply standard metadynamics when p_DEER(x) = 0.
-                deer = 1. / (probs[j] + 0.1)
-                # The distance better not ever be zero, so hopefully we don't have to worry about this case
-                if 0 not in [dists[i], dists[j]]:
-                    force_table[i, j] = pf * deer * (
-                        1. - dists[j] / dists[i]) * np.exp(exponent)
+        # add 0.1 to the probability so that we apply standard metadynamics when p_DEER(x) = 0.
+        # Same operation order as MultiPair.build_force_tables, so both give identical tables
+        columns = pf / (probs + 0.1)
+        force_table = (kernel * columns[None, :]).astype(np.float32)
 
         return force_table.tolist()
 
+    def build_potential_table(self, w=10, sigma=0.2, kernel_cache=None):
+        """
+        Integrate the force table along the current distance into a bias potential table, the sum of whose columns
+        weighted by the counts history is the EBMetaD bias (see bias.integrate_force_table).
+        :param w: weight, or height, of the Gaussians.
+        :param sigma: width of the Gaussians.
+        :param kernel_cache: optional KernelCache shared between pairs on the same bin grid.
+        :return: (nbins, nbins) float64 array.
+        """
+        force_table = self.build_force_table(w, sigma, kernel_cache=kernel_cache)
+        return integrate_force_table(force_table, self.get('bins'), sigma)
+
+    def bias_evaluator(self, w=10, sigma=0.2, counts=None):
+        """
+        :param w: weight, or height, of the Gaussians.
+        :param sigma: width of the Gaussians.
+        :param counts: default distance counts history.
+        :return: BiasEvaluator for this pair's force table.
+        """
+        return BiasEvaluator(self.build_force_table(w, sigma), self.get('bins'), sigma, counts)
+
+    def build_force_table_blocked(self, w=10, sigma=0.2, max_memory=2**28, filename=None):
+        """
+        Build the force table in blocks of rows so that the float64 temporaries never exceed max_memory bytes (the
+        float32 table itself is not counted). Intended for very fine grids, where the full table and its temporaries
+        do not fit in memory.
+        :param w: weight, or height, of the Gaussians.
+        :param sigma: width of the Gaussians.
+        :param max_memory: memory budget for the temporaries of one block, in bytes.
+        :param filename: if given, each block is written straight into a memory-mapped .npy file at this path.
+        :return: (nbins, nbins) float32 array (a numpy memmap if filename was given).
+        """
+        dists = self.get('bins')
+        probs = self.get('distribution')
+        nbins = len(probs)
+
+        probs = np.divide(probs, np.sum(probs))  # Normalization, just in case
+        columns = self.prefactor(w, sigma) / (probs + 0.1)
+
+        if filename:
+            force_table = np.lib.format.open_memmap(filename, mode='w+', dtype=np.float32, shape=(nbins, nbins))
+        else:
+            force_table = np.empty((nbins, nbins), dtype=np.float32)
+
+        block_rows = kernel_block_rows(nbins, max_memory)
+        for start in range(0, nbins, block_rows):
+            stop = min(start + block_rows, nbins)
+            kernel = build_kernel_rows(dists, sigma, start, stop)
+            np.multiply(kernel, columns[None, :], out=force_table[start:stop], casting='same_kind')
+            # Released before the next block is built
+            del kernel
+
+        if filename:
+            force_table.flush()
+        return force_table
+
 
 class MultiPair(MultiMetaData):
     def __init__(self):
         super().__init__()
         self.num_pairs = 0
+        self.kernel_cache = KernelCache()
+        self._fingerprints = []
 
-    def read_from_json(self, filename='state.json'):
+    def read_from_json(self, filename='state.json', cache=False):
+        """
+        Load all the pair data from a json file.
+        :param filename: path to the pair data.
+        :param cache: if True, read a binary sidecar (see read_sidecar) when one matches the json file, and write one
+        after parsing otherwise.
+        """
+        data = read_sidecar(filename) if cache else None
+        if data is None:
+            data = load_json(filename)
+            if cache:
+                write_sidecar(filename, data)
+        self.set_from_dictionary(data)
+
+    def set_from_dictionary(self, data):
+        """
+        Load all the pair data from an already parsed dictionary of pair name -> metadata (e.g. broadcast over MPI).
+        :param data: dictionary with the same layout as the pair data json.
+        """
         self._metadata_list = []
         self._names = []
-        data = json.load(open(filename, 'r'))
         for name, metadata in data.items():
             self._names.append(name)
             metadata_obj = PairData(name=name)
@@ -64,6 +376,82 @@ class MultiPair(MultiMetaData):
             self._metadata_list.append(metadata_obj)
 
         self.num_pairs = len(self._names)
+        self._fingerprints = [pair_fingerprint(pd) for pd in self._metadata_list]
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self._fingerprints[key] = pair_fingerprint(value)
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        del self._fingerprints[key]
+
+    def fingerprint(self, idx):
+        """
+        :param idx: index of the pair.
+        :return: content hash of the pair's distribution and bins (see pair_fingerprint).
+        """
+        return self._fingerprints[idx]
+
+    def build_force_tables(self, w=10, sigma=0.2, max_memory=2**28):
+        """
+        Build the force tables of all pairs at once. Pairs are grouped by number of bins and each group is computed
+        into one contiguous (pairs x nbins x nbins) float32 buffer. When the float64 kernels of every grid, plus the
+        temporaries of building one of them, fit in max_memory, the kernels are cached and reused (see KernelCache);
+        otherwise the buffers are filled in blocks of rows, as in PairData.build_force_table_blocked. Either way the
+        float64 temporaries never exceed max_memory bytes (the float32 tables themselves are not counted).
+        Pairs with identical distributions and bins are computed once and share the same table object.
+        :param w: weight, or height, of the Gaussians.
+        :param sigma: width of the Gaussians.
+        :param max_memory: memory budget for the float64 temporaries, in bytes.
+        :return: dictionary of pair name -> (nbins, nbins) float32 view into the buffer of that pair's group.
+        """
+        groups = {}
+        unique = {}
+        for idx, pd in enumerate(self._metadata_list):
+            fingerprint = self._fingerprints[idx]
+            if fingerprint not in unique:
+                unique[fingerprint] = idx
+                groups.setdefault(len(pd.get('bins')), {}).setdefault(bins_fingerprint(pd.get('bins')),
+                                                                      []).append(idx)
+
+        cached_bytes = sum(8 * nbins * nbins * len(grids) for nbins, grids in groups.items())
+        largest = max(groups, default=0)
+        use_cache = cached_bytes + (KERNEL_TEMPORARIES - 1) * 8 * largest * largest <= max_memory
+
+        tables = {}
+        for nbins, grids in groups.items():
+            # Pairs on the same grid are contiguous in the buffer, so each grid is filled through one slice
+            pds = [self._metadata_list[idx] for idxs in grids.values() for idx in idxs]
+            probs = np.array([pd.get('distribution') for pd in pds], dtype=np.float64)
+            probs /= np.sum(probs, axis=1, keepdims=True)
+            pf = np.array([pd.prefactor(w, sigma) for pd in pds])
+            # add 0.1 to the probability so that we apply standard metadynamics when p_DEER(x) = 0.
+            columns = (pf[:, None] / (probs + 0.1))[:, None, :]
+
+            buffer = np.empty((len(pds), nbins, nbins), dtype=np.float32)
+            block_rows = nbins if use_cache else kernel_block_rows(nbins, max_memory)
+            first = 0
+            for idxs in grids.values():
+                last = first + len(idxs)
+                bins = pds[first].get('bins')
+                for start in range(0, nbins, block_rows):
+                    stop = min(start + block_rows, nbins)
+                    if use_cache:
+                        kernel = self.kernel_cache.get(bins, sigma)
+                    else:
+                        kernel = build_kernel_rows(bins, sigma, start, stop)
+                    np.multiply(kernel[None, :, :], columns[first:last], out=buffer[first:last, start:stop],
+                                casting='same_kind')
+                    del kernel
+                first = last
+            for k, pd in enumerate(pds):
+                tables[pd.name] = buffer[k]
+
+        for idx, pd in enumerate(self._metadata_list):
+            if pd.name not in tables:
+                tables[pd.name] = tables[self._metadata_list[unique[self._fingerprints[idx]]].name]
+        return tables
 
 
 
@@ -5,6 +5,7 @@ Each class corresponds to ONE restraint since gmxapi plugins each correspond to
 
 from run_ebmetad.metadata import MetaData
 from abc import abstractmethod
+import numpy as np
 import gmx
 
 
@@ -18,9 +19,7 @@ class PluginConfig(MetaData):
         :param dictionary: a dictionary containing metadata, some of which may be needed for the run.
         The dictionary may contain *extra* data, i.e., this can be a superset of the needed plugin data.
         """
-        for requirement in self.get_requirements():
-            if requirement in dictionary.keys():
-                self.set(requirement, dictionary[requirement])
+        self.update(**{key: dictionary[key] for key in self.get_requirement_set() & dictionary.keys()})
 
     def scan_metadata(self, data):
         """
@@ -48,11 +47,13 @@ class EBMetaDPluginConfig(PluginConfig):
     def build_plugin(self):
         if self.get_missing_keys():
             raise KeyError('Must define {}'.format(self.get_missing_keys()))
-        print(self.get_as_dictionary().keys())
+        # The plugin expects plain python sequences; force tables may be numpy views into a shared buffer
+        params = {key: value.tolist() if isinstance(value, np.ndarray) else value
+                  for key, value in self.get_as_dictionary().items()}
         potential = gmx.workflow.WorkElement(
             namespace="myplugin",
             operation="ebmetad_restraint",
             depends=[],
-            params=self.get_as_dictionary())
+            params=params)
         potential.name = '{}'.format(self.get('sites'))
         return potential
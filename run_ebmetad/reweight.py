@@ -0,0 +1,196 @@
+"""
+Recovers unbiased distance distributions from biased EBMetaD sampling.
+Distance time series are streamed in chunks (text or .npy), the bias of every frame is evaluated from the restraint's
+potential table and the distance counts history as it evolves during the run, and weighted histograms are
+accumulated for every pair in one pass with bounded memory. Ensemble members are processed in parallel.
+"""
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+import numpy as np
+from run_ebmetad.bias import integrate_force_table
+from run_ebmetad.bins import BinIndex
+from run_ebmetad.directory_helper import DirectoryHelper
+from run_ebmetad.run_data import RunData
+
+# kT in kJ/mol at 300 K (GROMACS units)
+KT_300K = 2.494
+
+
+def read_distance_chunks(fnm, chunk_size=10000):
+    """
+    Stream a distance time series, one row per frame and one column per pair.
+    .npy files are memory-mapped; anything else is read as whitespace-separated text, skipping lines that start with
+    '#' or '@' (xvg headers).
+    :param fnm: path to the time series.
+    :param chunk_size: number of frames per chunk.
+    :return: generator of (frames, pairs) float arrays.
+    """
+    if fnm.endswith('.npy'):
+        data = np.load(fnm, mmap_mode='r')
+        for start in range(0, len(data), chunk_size):
+            chunk = np.asarray(data[start:start + chunk_size], dtype=np.float64)
+            yield chunk[:, None] if chunk.ndim == 1 else chunk
+        return
+
+    with open(fnm, 'r') as f:
+        lines = (line for line in f if line.strip() and not line.startswith(('#', '@')))
+        while True:
+            chunk = list(islice(lines, chunk_size))
+            if not chunk:
+                return
+            yield np.loadtxt(chunk, ndmin=2)
+
+
+class WeightedHistogram:
+    """
+    Histogram of exp(log_weight) accumulated in a scaled form (hist * exp(log_scale)) so that large biases never
+    overflow.
+    """
+
+    def __init__(self, nbins):
+        self.hist = np.zeros(nbins)
+        self.log_scale = -np.inf
+
+    def add(self, idx, log_weights):
+        if not len(idx):
+            return
+        top = np.max(log_weights)
+        if top > self.log_scale:
+            self.hist *= np.exp(self.log_scale - top)
+            self.log_scale = top
+        self.hist += np.bincount(idx, weights=np.exp(log_weights - self.log_scale), minlength=len(self.hist))
+
+    def merge(self, other):
+        if other.log_scale == -np.inf:
+            return
+        top = max(self.log_scale, other.log_scale)
+        self.hist = self.hist * np.exp(self.log_scale - top) + other.hist * np.exp(other.log_scale - top)
+        self.log_scale = top
+
+    def distribution(self):
+        total = np.sum(self.hist)
+        return self.hist / total if total else self.hist
+
+
+class PairReweighter:
+    """
+    Per-restraint reweighting state: the potential table, the evolving counts history and the weighted histogram.
+    """
+
+    def __init__(self, potential_table, bins, counts=None, kT=KT_300K, evolve=True, count_stride=1):
+        """
+        :param potential_table: (nbins, nbins) potential table (see bias.integrate_force_table).
+        :param bins: distance bins of the table.
+        :param counts: distance counts at the first frame; defaults to all ones (a fresh run).
+        :param kT: thermal energy, in the units of the potential.
+        :param evolve: if True, every counted frame adds to the history, as during the run. If False, the bias is
+        evaluated against a fixed history.
+        :param count_stride: the history is incremented every count_stride frames (the sample period divided by the
+        output interval of the time series).
+        """
+        self.potential_table = np.asarray(potential_table, dtype=np.float64)
+        self.index = BinIndex(bins)
+        nbins = len(self.index)
+        self.counts = np.ones(nbins) if counts is None else np.array(counts, dtype=np.float64)
+        # Bias at every bin for the current history; updated one column at a time as frames are counted
+        self.profile = self.potential_table.dot(self.counts)
+        self.kT = kT
+        self.evolve = evolve
+        self.count_stride = count_stride
+        self.histogram = WeightedHistogram(nbins)
+        self.frames = 0
+
+    def bias(self, distances):
+        """
+        Bias of every frame in a chunk, and update of the counts history. Frames between two counted frames see the
+        same history, so their bias is one lookup in the 1D bias profile, and memory stays O(nbins) for any chunk.
+        :param distances: 1D array of distances for consecutive frames.
+        :return: (bin indices, bias per frame)
+        """
+        idx = self.index.lookup(distances)
+        bias = np.empty(len(idx))
+        start = 0
+        if self.evolve:
+            counted = np.flatnonzero((self.frames + np.arange(len(idx))) % self.count_stride == 0)
+            for frame in counted:
+                # A counted frame is biased by the history before it
+                bias[start:frame + 1] = self.profile[idx[start:frame + 1]]
+                self.profile += self.potential_table[:, idx[frame]]
+                self.counts[idx[frame]] += 1
+                start = frame + 1
+        bias[start:] = self.profile[idx[start:]]
+        self.frames += len(idx)
+        return idx, bias
+
+    def add(self, distances):
+        idx, bias = self.bias(distances)
+        self.histogram.add(idx, bias / self.kT)
+
+
+def reweight_member(run_data, distances_fnm, names=None, kT=KT_300K, chunk_size=10000, evolve=True,
+                    count_stride=1, initial_counts=None):
+    """
+    Reweight one ensemble member's distance time series.
+    :param run_data: RunData with force tables and bins for every restraint.
+    :param distances_fnm: time series with one column per pair (see read_distance_chunks).
+    :param names: pair names, in column order; defaults to the RunData pair order.
+    :param kT: thermal energy, in the units of the potential.
+    :param chunk_size: number of frames processed at a time.
+    :param evolve: evolve the counts history frame by frame (see PairReweighter).
+    :param count_stride: frames between increments of the history.
+    :param initial_counts: dictionary of pair name -> counts at the first frame; defaults to all ones.
+    :return: dictionary of pair name -> WeightedHistogram.
+    """
+    names = names or list(run_data.pair_params.keys())
+    initial_counts = initial_counts or {}
+    reweighters = {}
+    for name in names:
+        bins = run_data.get('bins', name=name)
+        potential_table = integrate_force_table(run_data.get('force_table', name=name), bins, run_data.get('sigma'))
+        reweighters[name] = PairReweighter(potential_table, bins, initial_counts.get(name), kT, evolve, count_stride)
+
+    for chunk in read_distance_chunks(distances_fnm, chunk_size):
+        for column, name in enumerate(names):
+            reweighters[name].add(chunk[:, column])
+    return {name: reweighter.histogram for name, reweighter in reweighters.items()}
+
+
+def reweight_ensemble(ensemble_dir, distances_fnm='distances.npy', names=None, kT=KT_300K, chunk_size=10000,
+                      evolve=True, count_stride=1, max_workers=None):
+    """
+    Reweight every ensemble member in parallel and combine the results.
+    Each ensemble_dir/mem_{n} directory must contain run_config.json (with force tables) and the distance time series.
+    :param ensemble_dir: path to top directory which contains the full ensemble.
+    :param distances_fnm: name of the time series file within each member directory.
+    :param names: pair names, in column order; defaults to the RunData pair order.
+    :param kT: thermal energy, in the units of the potential.
+    :param chunk_size: number of frames processed at a time.
+    :param evolve: evolve the counts history frame by frame (see PairReweighter).
+    :param count_stride: frames between increments of the history.
+    :param max_workers: size of the thread pool.
+    :return: dictionary of pair name -> unbiased distribution.
+    """
+    def member_histograms(member_dir):
+        run_data = RunData()
+        run_data.load_config(os.path.join(member_dir, 'run_config.json'))
+        return reweight_member(run_data, os.path.join(member_dir, distances_fnm), names, kT, chunk_size, evolve,
+                               count_stride)
+
+    member_dirs = []
+    for member in DirectoryHelper.list_members(ensemble_dir):
+        member_dir = DirectoryHelper(top_dir=ensemble_dir, ensemble_num=member).get_dir('ensemble_num')
+        if os.path.exists(os.path.join(member_dir, distances_fnm)):
+            member_dirs.append(member_dir)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = list(executor.map(member_histograms, member_dirs))
+
+    combined = {}
+    for histograms in results:
+        for name, histogram in histograms.items():
+            if name not in combined:
+                combined[name] = WeightedHistogram(len(histogram.hist))
+            combined[name].merge(histogram)
+    return {name: histogram.distribution() for name, histogram in combined.items()}
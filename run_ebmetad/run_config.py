@@ -1,10 +1,14 @@
 from run_ebmetad.run_data import RunData
 from run_ebmetad.pair_data import MultiPair
+from run_ebmetad.metadata import file_fingerprint
 from run_ebmetad.plugin_configs import EBMetaDPluginConfig
 from run_ebmetad.directory_helper import DirectoryHelper
+from run_ebmetad.shared_history import SharedHistory
+from run_ebmetad.log_config import member_logger
 from copy import deepcopy
 import os
 import logging
+import time
 import gmx
 import numpy as np
 
@@ -14,7 +18,9 @@ class RunConfig:
     Run configuration for single EBMetaD ensemble member.
     """
 
-    def __init__(self, tpr, ensemble_dir, ensemble_num=1, pairs_json='pair_data.json'):
+    def __init__(self, tpr, ensemble_dir, ensemble_num=1, pairs_json='pair_data.json', shared_history=None,
+                 resume=False, cache_pairs=False, general_params=None, scratch_dir=None, sync_interval=60.,
+                 log_level=logging.DEBUG, names=None):
         """
         The run configuration specifies the files and directory structure used for the run.
         :param tpr: path to tpr. Must be gmx 2017 compatible.
@@ -22,62 +28,169 @@ class RunConfig:
         :param ensemble_num: the ensemble member to run.
         :param pairs_json: path to file containing *ALL* the pair metadata. An example of
         what such a file should look like is provided in the examples directory.
-
-        :
+        :param shared_history: optional path to a multi-walker history file shared with other members
+        (see SharedHistory). If given, distance counts are initialized from, and contributed back to, that file.
+        Counts are only exchanged between segments (see run_segments), not during one.
+        :param resume: if True and the member directory already holds a complete run_config.json built from the same
+        pair file and ensemble number, load it (including the force tables) instead of deriving everything again.
+        :param cache_pairs: if True, read the pair data through a binary sidecar cache next to pairs_json
+        (see MultiPair.read_from_json).
+        :param general_params: optional dictionary of general parameters (w, sigma, k, rebin_ratio, ...) that override
+        the defaults. They are applied before the pair data are processed, so they also affect rebinning.
+        :param scratch_dir: optional node-local directory. If given, the member runs in a staged copy of its directory
+        under scratch_dir, and changed files are synced back to ensemble_dir in the background (see
+        DirectoryHelper.stage).
+        :param sync_interval: time between sync-back passes in seconds, when staging on scratch.
+        :param log_level: level name or number of the member's log (see log_config.member_logger).
+        :param names: optional list of pair names to restrain (e.g. from selection.select_pairs); the other pairs in
+        pairs_json are ignored. By default every pair is restrained.
         """
         self.tpr = tpr
         self.ens_dir = ensemble_dir
+        self.__pairs_json = pairs_json
+        self.__parsed_pairs = None
+        self.__pairs = None
+        self.__pairs_key = None
+        self.__cache_pairs = cache_pairs
+        self.__selected = list(names) if names else None
+        self.__scratch_dir = scratch_dir
+        self.__sync_interval = sync_interval
+        self.__sync = None
 
         # a list of identifiers of the residue-residue pairs that will be restrained
         self.__names = []
 
-        # Load the pair data from a json. Use this to set up the run metadata
-        self.pairs = MultiPair()
-        self.pairs.read_from_json(pairs_json)
-        # use the same identifiers for the pairs here as those provided in the pair metadata
-        # file this prevents mixing up pair data amongst the different pairs (i.e.,
-        # accidentally applying the restraints for pair 1 to pair 2.)
-        self.__names = self.pairs.get_names()
-
         self.run_data = RunData()
+        general_params = general_params or {}
+        fingerprint = {
+            'pairs_json': file_fingerprint(pairs_json),
+            'ensemble_num': ensemble_num,
+            'general_params': general_params,
+            'names': self.__selected
+        }
+        self.resumed = resume and self.__load_saved_config(fingerprint)
 
-        # Set up run data for each pair
-        self.run_data.set(ensemble_num=ensemble_num)
-        for pd in self.pairs:
-            self.run_data.from_pair_data(pd)
-        self.run_data.save_config('run_config.json')
+        if not self.resumed:
+            self.run_data.set(ensemble_num=ensemble_num, **general_params)
+
+            # use the same identifiers for the pairs here as those provided in the pair metadata
+            # file this prevents mixing up pair data amongst the different pairs (i.e.,
+            # accidentally applying the restraints for pair 1 to pair 2.)
+            self.__names = self.pairs.get_names()
+
+            # Set up run data for each pair
+            for pd in self.pairs:
+                self.run_data.from_pair_data(pd)
+            self.run_data.fingerprint = fingerprint
+            self.run_data.save_config('run_config.json')
 
         # List of plugins
         self.__plugins = []
 
+        # Multi-walker history, and the counts each restraint started from in the current segment
+        self.__shared_history = None
+        if shared_history:
+            if self.resumed:
+                nbins = max(len(self.run_data.get('force_table', name=name)) for name in self.__names)
+            else:
+                nbins = max(len(pd.get('bins')) for pd in self.pairs)
+            self.__shared_history = SharedHistory(shared_history, self.__names, nbins)
+        self.__initial_counts = {}
+        # id of a force table -> (table, table as nested lists) for the plugins
+        self.__table_lists = {}
+        self.segment_timings = []
+
         # Logging
-        self._logger = logging.getLogger('EBMetaD')
-        self._logger.setLevel(logging.DEBUG)
-        # create file handler which logs even debug messages
-        fh = logging.FileHandler('ebmetad{}.log'.format(ensemble_num))
-        fh.setLevel(logging.DEBUG)
-        # create console handler with a higher log level
-        ch = logging.StreamHandler()
-        ch.setLevel(logging.DEBUG)
-        # create formatter and add it to the handlers
-        formatter = logging.Formatter('%(asctime)s:%(name)s:%(levelname)s - %(message)s')
-        fh.setFormatter(formatter)
-        ch.setFormatter(formatter)
-        # add the handlers to the logger
-        self._logger.addHandler(fh)
-        self._logger.addHandler(ch)
+        self._logger = member_logger(ensemble_num, log_level=log_level)
 
         self._logger.info("Names of restraints: {}".format(self.__names))
+        if self.resumed:
+            self._logger.info("Resumed from saved run configuration")
+
+    @property
+    def pairs(self):
+        # The pair data are only parsed when needed; a resumed run with up-to-date force tables never needs them
+        if self.__parsed_pairs is None:
+            multi_pair = MultiPair()
+            multi_pair.read_from_json(self.__pairs_json, cache=self.__cache_pairs)
+            data = multi_pair.get_as_single_dataset()
+            if self.__selected:
+                missing = [name for name in self.__selected if name not in data]
+                if missing:
+                    raise ValueError('Pairs {} are not in {}'.format(missing, self.__pairs_json))
+                data = {name: data[name] for name in self.__selected}
+            self.__parsed_pairs = data
+        # Use the grid selected by the general parameters, so the force tables match the run data. The rebinned pairs
+        # are rebuilt from the parsed data whenever those parameters change.
+        key = (self.run_data.get('sigma'), self.run_data.get('rebin_ratio'))
+        if self.__pairs is None or self.__pairs_key != key:
+            self.__pairs = MultiPair()
+            self.__pairs.set_from_dictionary(self.__parsed_pairs)
+            for i, pd in enumerate(self.__pairs):
+                resolved = self.run_data.resolve_pair_data(pd)
+                if resolved is not pd:
+                    self.__pairs[i] = resolved
+            self.__pairs_key = key
+            self.__resolve_grids()
+        return self.__pairs
+
+    def __resolve_grids(self):
+        # Restraints already in the run data on another grid take the grid (bins, bin_width, min_dist, max_dist) of
+        # the rebinned pairs. Their force tables and counts belong to the old grid, so they are dropped; the counts
+        # file is kept.
+        for pd in self.__pairs:
+            if pd.name not in self.run_data.pair_params:
+                continue
+            if np.array_equal(self.run_data.get('bins', name=pd.name), pd.get('bins')):
+                continue
+            hist_data_fnm = self.run_data.get('historical_data_filename', name=pd.name)
+            self.run_data.from_pair_data(pd)
+            self.run_data.set(name=pd.name, historical_data_filename=hist_data_fnm)
+
+    def __load_saved_config(self, fingerprint):
+        member_dir = DirectoryHelper(top_dir=self.ens_dir, ensemble_num=fingerprint['ensemble_num']).get_dir(
+            'ensemble_num')
+        fnm = os.path.join(member_dir, 'run_config.json')
+        if not os.path.exists(fnm):
+            return False
+
+        saved = RunData()
+        saved.load_config(fnm)
+        if {key: saved.fingerprint.get(key) for key in fingerprint} != fingerprint:
+            return False
+        if 'force_table_params' not in saved.fingerprint:
+            return False
+        for params in saved.pair_params.values():
+            if params.get_missing_keys() and params.get_missing_keys() != ['distance_counts']:
+                return False
+
+        # Counts and general parameters saved after the last segment, if it ran after the tables were written
+        state_fnm = os.path.join(member_dir, 'run_state.json')
+        if os.path.exists(state_fnm):
+            saved.load_state(state_fnm)
+        self.run_data = saved
+        self.__names = list(saved.pair_params.keys())
+        return True
 
     def __calculate_force_table(self):
         # TODO: test this properly in pytest.
-        for i in range(self.pairs.num_pairs):
-            pd = self.pairs[i]
-            name = pd.name
+        # w and sigma are general parameters, so every table can be built in one batch
+        w = self.run_data.get('w')
+        sigma = self.run_data.get('sigma')
+        # rebin_ratio selects the grid, so it is part of what the tables were built for
+        force_table_params = {'w': w, 'sigma': sigma, 'rebin_ratio': self.run_data.get('rebin_ratio')}
+        have_tables = all('force_table' in self.run_data.pair_params[name].get_as_dictionary()
+                          for name in self.__names)
+        if have_tables and self.run_data.fingerprint.get('force_table_params') == force_table_params:
+            return
 
-            w = self.run_data.get('w', name=name)
-            sigma = self.run_data.get('sigma', name=name)
-            self.run_data.set(name=name, force_table=pd.build_force_table(w, sigma))
+        force_tables = self.pairs.build_force_tables(w, sigma)
+        for name in self.__names:
+            self.run_data.set(name=name, force_table=force_tables[name])
+        # The tables are all that is needed from the pair data; they are parsed again if w or sigma change
+        self.__parsed_pairs = None
+        self.__pairs = None
+        self.run_data.fingerprint['force_table_params'] = force_table_params
         self.run_data.save_config(fnm='run_config.json')
 
     def build_plugins(self, plugin_config):
@@ -87,49 +200,151 @@ class RunConfig:
         self.__plugins = []
         general_params = self.run_data.as_dictionary()['general parameters']
         self.__calculate_force_table()
+        # Only the list conversions of the current tables are kept
+        current = {id(self.run_data.get('force_table', name=name)) for name in self.__names}
+        self.__table_lists = {key: value for key, value in self.__table_lists.items() if key in current}
 
         # For each pair-wise restraint, populate the plugin with data: both the "general" data and
         # the data unique to that restraint.
         for name in self.__names:
 
+            # The plugin indexes distances as multiples of bin_width; non-uniform grids are only supported by the
+            # python-side analysis tools.
+            if not self.run_data.bin_index(name).uniform:
+                raise ValueError('The gmxapi plugin requires a uniform distance grid; {} is not uniform'.format(name))
+
             # We assume we've changed into the working directory. Therefore, we can check to see if a historical data
             # file exists. If it does, we read it, if is does not, we initialize a vector of all zero counts.
 
             hist_data_fnm = self.run_data.get('historical_data_filename', name=name)
-            if os.path.exists(hist_data_fnm):
+            num_bins = len(self.run_data.get('force_table', name=name))
+            if self.__shared_history:
+                distance_counts = self.__shared_history.get(name, num_bins).tolist()
+            elif os.path.exists(hist_data_fnm):
                 distance_counts = np.loadtxt(hist_data_fnm, dtype=int).tolist()
             else:
-                num_bins = len(self.run_data.get('force_table', name=name))
+                distance_counts = [1] * num_bins
+            if len(distance_counts) != num_bins:
+                # The history was sampled on another grid (sigma or rebin_ratio changed); start a fresh one
+                self._logger.warning("{} has {} bins but the force table of {} has {}; resetting the counts".format(
+                    hist_data_fnm, len(distance_counts), name, num_bins))
                 distance_counts = [1] * num_bins
 
             self.run_data.set(name=name, distance_counts=distance_counts)
+            self.__initial_counts[name] = np.array(distance_counts)
 
-            pair_params = self.run_data.as_dictionary()['pair parameters'][name]
+            pair_params = dict(self.run_data.pair_params[name].get_as_dictionary())
+            pair_params['force_table'] = self.__table_list(pair_params['force_table'])
             new_restraint = deepcopy(plugin_config)
             new_restraint.scan_dictionary(general_params)  # load general data into current restraint
             new_restraint.scan_dictionary(pair_params)  # load pair-specific data into current restraint
             self.__plugins.append(new_restraint.build_plugin())
+            self._logger.debug("Built plugin for {} with parameters {}".format(
+                name, list(new_restraint.get_as_dictionary().keys())))
+
+    def __table_list(self, force_table):
+        # The plugin takes plain python lists. Converting a table costs about as much as serializing it, so each table
+        # is converted once and reused by the following segments; the table is kept with its list, so its id cannot
+        # be reused by another object.
+        if not isinstance(force_table, np.ndarray):
+            return force_table
+        key = id(force_table)
+        if key not in self.__table_lists:
+            self.__table_lists[key] = (force_table, force_table.tolist())
+        return self.__table_lists[key][1]
+
+    def __share_history(self):
+        # Contribute the counts sampled during this segment to the multi-walker history
+        deltas = {}
+        for name in self.__names:
+            hist_data_fnm = self.run_data.get('historical_data_filename', name=name)
+            if name in self.__initial_counts and os.path.exists(hist_data_fnm):
+                counts = np.loadtxt(hist_data_fnm, dtype=int)
+                deltas[name] = counts - self.__initial_counts[name]
+        self.__shared_history.contribute(deltas)
+        self._logger.info("Contributed counts to shared history {}".format(self.__shared_history.path))
 
     def __change_directory(self):
         # change into the current working directory (ensemble_path/member_path/)
-        dir_help = DirectoryHelper(top_dir=self.ens_dir, ensemble_num=self.run_data.get('ensemble_num'))
-        dir_help.build_working_dir()
-        dir_help.change_dir('ensemble_num')
+        dir_help = DirectoryHelper(top_dir=self.ens_dir, ensemble_num=self.run_data.get('ensemble_num'),
+                                   scratch_dir=self.__scratch_dir)
+        if self.__scratch_dir is None:
+            dir_help.build_working_dir()
+            dir_help.change_dir('ensemble_num')
+            return
+        # Stage only once: the scratch copy may hold results that have not been synced back yet
+        if self.__sync is None:
+            self.__sync = dir_help.stage(sync_interval=self.__sync_interval)
+            self._logger.info("Staged {} on {}".format(dir_help.get_dir('ensemble_num'), dir_help.get_dir('scratch')))
+        dir_help.change_dir('scratch')
+
+    def __request_sync(self):
+        # Results are copied back by the background thread; MD never waits on the shared filesystem
+        if self.__sync is not None:
+            self.__sync.start()
+            self.__sync.request()
 
-    def __production(self, nsteps=None):
+    def sync(self):
+        """
+        Copy everything that changed on scratch back to the ensemble directory, and wait for it. Does nothing unless
+        the member is staged; otherwise the final sync happens at interpreter exit.
+        :return: list of copied files, relative to the member directory.
+        """
+        return self.__sync.stop() if self.__sync is not None else []
+
+    def __production(self, nsteps=None, append_output=False):
+        # Returns the time spent inside the MD engine
         if nsteps:
-            md = gmx.workflow.from_tpr(self.tpr, append_output=False, nsteps=nsteps)
+            md = gmx.workflow.from_tpr(self.tpr, append_output=append_output, nsteps=nsteps)
         else:
-            md = gmx.workflow.from_tpr(self.tpr, append_output=False)
+            md = gmx.workflow.from_tpr(self.tpr, append_output=append_output)
 
+        # Force tables are only rebuilt if w or sigma changed; the counts are re-read from the history files
         self.build_plugins(EBMetaDPluginConfig())
         for plugin in self.__plugins:
             md.add_dependency(plugin)
         context = gmx.context.ParallelArrayContext(md, workdir_list=[os.getcwd()])
+        start = time.time()
         with context as session:
             session.run()
+        return time.time() - start
 
     def run(self, nsteps=None):
         self.__change_directory()
         self.__production(nsteps=nsteps)
-        self.run_data.save_config('run_config.json')
+        if self.__shared_history:
+            self.__share_history()
+        # The force tables were written to run_config.json when they were built
+        self.run_data.save_state('run_state.json')
+        self.__request_sync()
+
+    def run_segments(self, segments, nsteps=None):
+        """
+        Run several segments back to back in one process. Every segment after the first continues from the
+        checkpoint and appends to the output of the previous one; the run data, force tables (and their conversions for
+        the plugins) and (if any) shared history stay loaded, so only the updated counts are read between segments.
+        The force tables are written to run_config.json once, when they are built; after every segment only the
+        counts and general parameters are saved, to run_state.json.
+        :param segments: number of segments.
+        :param nsteps: number of MD steps per segment.
+        :return: list of per-segment timings: {'segment', 'wall_time', 'md_time', 'overhead'} in seconds.
+        """
+        self.__change_directory()
+        timings = []
+        for segment in range(segments):
+            start = time.time()
+            md_time = self.__production(nsteps=nsteps, append_output=segment > 0)
+            if self.__shared_history:
+                self.__share_history()
+            self.run_data.save_state('run_state.json')
+            self.__request_sync()
+            wall_time = time.time() - start
+            timings.append({
+                'segment': segment,
+                'wall_time': wall_time,
+                'md_time': md_time,
+                'overhead': wall_time - md_time
+            })
+            self._logger.info("Segment {} finished; python overhead {:.3f} s".format(segment, wall_time - md_time))
+        self.segment_timings = timings
+        return timings
@@ -4,38 +4,42 @@ doi: 10.1016/j.bpj.2015.05.024
 """
 
 from run_ebmetad.pair_data import PairData
-from run_ebmetad.metadata import MetaData
-import json
+from run_ebmetad.metadata import MetaData, dump_json, load_json
+from run_ebmetad.bins import BinIndex, is_uniform
+from run_ebmetad.bias import BiasEvaluator
 import numpy as np
 
 
-def get_min_max(probs, bin_width):
+def get_min_max(probs, bins):
+    """
+    Distances at which the EBMetaD restraints are turned off: the first and last bins whose probability exceeds a
+    small cutoff.
+    :param probs: DEER distribution.
+    :param bins: the distance bins. A scalar is interpreted as the width of a uniform grid starting at zero.
+    :return: (min_dist, max_dist)
+    """
     cutoff = 0.005
-    max_dist = bin_width * (len(probs) - 1)
-    min_dist = bin_width
-
-    mask = np.array(probs) > cutoff
-    for i in range(len(mask)):
-        if mask[i]:
-            min_dist = i * bin_width
-            break
-    for i in range(len(mask) - 1, 0, -1):
-        if mask[i]:
-            max_dist = i * bin_width
-            break
-        max_dist = (len(mask) - 1) * bin_width
-    return min_dist, max_dist
+    if np.ndim(bins) == 0:
+        bins = bins * np.arange(len(probs))
+    bins = np.asarray(bins, dtype=np.float64)
+
+    above = np.flatnonzero(np.asarray(probs) > cutoff)
+    min_dist = bins[above[0]] if above.size else bins[1]
+    max_dist = bins[above[-1]] if above.size and above[-1] > 0 else bins[-1]
+    return float(min_dist), float(max_dist)
 
 
 class GeneralParams(MetaData):
     """
     Stores the parameters that are shared by all restraints in a single simulation.
     Includes the standard MetaDynamics parameters w, sigma, and the sampling interval, as well as the ensemble number.
+    rebin_ratio optionally coarsens the DEER distributions to a bin width of rebin_ratio * sigma (0 keeps the
+    original grid), which shrinks the force tables quadratically.
     """
 
     def __init__(self):
         super().__init__('general')
-        self.set_requirements(['w', 'sigma', 'sample_period', 'k', 'ensemble_num'])
+        self.set_requirements(['w', 'sigma', 'sample_period', 'k', 'ensemble_num', 'rebin_ratio'])
 
 
 class PairParams(MetaData):
@@ -48,10 +52,70 @@ class PairParams(MetaData):
     def __init__(self, name):
         super().__init__(name)
         self.set_requirements([
-            'sites', 'force_table', 'distance_counts', 'min_dist', 'max_dist', 'bin_width', 'historical_data_filename'
+            'sites', 'force_table', 'distance_counts', 'min_dist', 'max_dist', 'bin_width', 'bins',
+            'historical_data_filename'
         ])
 
 
+class PairColumns:
+    """
+    Struct-of-arrays view over the scalar pair-specific parameters of a RunData object.
+    Each column is a numpy array aligned to `names`, the order in which the pairs were added.
+    Columns are cached and invalidated by RunData.set, so they stay in sync as long as parameters are changed through
+    RunData (not through the PairParams objects directly).
+    """
+    scalar_keys = ['min_dist', 'max_dist', 'bin_width']
+
+    def __init__(self, run_data):
+        self._run_data = run_data
+        self._cache = {}
+
+    @property
+    def names(self):
+        return list(self._run_data.pair_params.keys())
+
+    def invalidate(self, key=None):
+        if key is None:
+            self._cache = {}
+        else:
+            self._cache.pop(key, None)
+
+    def __getitem__(self, key):
+        """
+        :param key: a scalar pair-specific parameter, or a general parameter (broadcast to every pair).
+        :return: read-only float array with one entry per pair.
+        """
+        if key not in self._cache:
+            if self._run_data.general_params.is_required(key):
+                column = np.full(len(self.names), self._run_data.get(key), dtype=float)
+            elif key in self.scalar_keys:
+                column = np.array([params.get(key) for params in self._run_data.pair_params.values()], dtype=float)
+            else:
+                raise KeyError('{} is not a scalar parameter'.format(key))
+            column.setflags(write=False)
+            self._cache[key] = column
+        return self._cache[key]
+
+    def __setitem__(self, key, values):
+        self.set(**{key: values})
+
+    def set(self, **columns):
+        """
+        Bulk setter for pair-specific scalar parameters.
+        :param columns: parameter -> scalar (applied to every pair) or array aligned to `names`.
+        """
+        names = self.names
+        for key, values in columns.items():
+            if key not in self.scalar_keys:
+                raise ValueError('{} is not a scalar pair-specific parameter'.format(key))
+            values = np.broadcast_to(np.asarray(values, dtype=float), (len(names),))
+            for name, value in zip(names, values.tolist()):
+                self._run_data.pair_params[name].set(key, value)
+            column = np.array(values)
+            column.setflags(write=False)
+            self._cache[key] = column
+
+
 class RunData:
     """
     Stores (and manipulates, to a lesser extent) all the metadata for a EBMetaD run.
@@ -63,10 +127,21 @@ class RunData:
         and the pair-specific parameters.
         """
         self.general_params = GeneralParams()
-        self.__defaults_general = {'w': 10, 'k': 100, 'sigma': 0.2, 'sample_period': 500, 'ensemble_num': 1}
+        self.__defaults_general = {
+            'w': 10,
+            'k': 100,
+            'sigma': 0.2,
+            'sample_period': 500,
+            'ensemble_num': 1,
+            'rebin_ratio': 0
+        }
         self.general_params.set_from_dictionary(self.__defaults_general)
         self.pair_params = {}
         self.__names = []
+        # Columnar view over the scalar pair parameters
+        self.columns = PairColumns(self)
+        # Describes the inputs the metadata were derived from (pair file hash, ensemble member, force table w/sigma)
+        self.fingerprint = {}
 
     def set(self, name=None, **kwargs):
         """
@@ -74,19 +149,18 @@ class RunData:
         :param name: restraint name. These are the same identifiers that are used in the RunConfig
         :param kwargs: parameters and their values.
         """
-        for key, value in kwargs.items():
-            # If a restraint name is not specified, it is assumed that the parameter is a "general" parameter.
+        # If a restraint name is not specified, it is assumed that the parameter is a "general" parameter.
+        # All keys are validated in one pass before anything is set.
+        params = self.pair_params[name] if name else self.general_params
+        unknown = kwargs.keys() - params.get_requirement_set()
+        if unknown:
             if not name:
-                if key in self.general_params.get_requirements():
-                    self.general_params.set(key, value)
-                else:
-                    raise ValueError('You have provided a name; this means you are probably trying to set a '
-                                     'pair-specific parameter. {} is not pair-specific'.format(key))
-            else:
-                if key in self.pair_params[name].get_requirements():
-                    self.pair_params[name].set(key, value)
-                else:
-                    raise ValueError('{} is not a pair-specific parameter'.format(key))
+                raise ValueError('You have not provided a name; this means you are probably trying to set a '
+                                 'general parameter. {} are not general parameters'.format(sorted(unknown)))
+            raise ValueError('{} are not pair-specific parameters'.format(sorted(unknown)))
+        params.update(**kwargs)
+        for key in kwargs:
+            self.columns.invalidate(key)
 
     def get(self, key, name=None):
         """
@@ -95,7 +169,7 @@ class RunData:
         :param name: if getting a pair-specific parameter, specify the restraint name.
         :return: the parameter value.
         """
-        if key in self.general_params.get_requirements():
+        if self.general_params.is_required(key):
             return self.general_params.get(key)
         elif name:
             return self.pair_params[name].get(key)
@@ -131,18 +205,65 @@ class RunData:
         Loads metadata into the class from a dictionary.
         :param data: RunData metadata as a dictionary.
         """
-        self.general_params.set_from_dictionary(data['general parameters'])
+        # Configurations saved before a general parameter existed get its default value
+        self.general_params.set_from_dictionary(dict(self.__defaults_general, **data['general parameters']))
+        self.columns.invalidate()
+        self.fingerprint = data.get('fingerprint', {})
+        shared = data.get('force tables', {})
         for name in data['pair parameters'].keys():
             self.pair_params[name] = PairParams(name)
             self.pair_params[name].set_from_dictionary(data['pair parameters'][name])
+            force_table = data['pair parameters'][name].get('force_table')
+            if isinstance(force_table, dict):
+                # Shared force table: resolve the reference so that the pairs share one object again
+                self.pair_params[name].set('force_table', shared[force_table['shared']])
+
+    def bin_index(self, name):
+        """
+        :param name: restraint name.
+        :return: BinIndex for vectorized distance -> bin lookups on that restraint's grid.
+        """
+        return BinIndex(self.get('bins', name=name))
+
+    def bias_evaluator(self, name, counts=None):
+        """
+        :param name: restraint name.
+        :param counts: distance counts history; defaults to the restraint's distance_counts, if set.
+        :return: BiasEvaluator built from the restraint's force table and grid.
+        """
+        params = self.pair_params[name].get_as_dictionary()
+        if counts is None:
+            counts = params.get('distance_counts')
+        return BiasEvaluator(self.get('force_table', name=name), self.get('bins', name=name), self.get('sigma'),
+                             counts)
+
+    def resolve_pair_data(self, pd: PairData):
+        """
+        Apply the grid selected by the general parameters (see rebin_ratio) to a PairData object.
+        :param pd: PairData object.
+        :return: the rebinned PairData, or pd itself if no coarsening is requested or needed.
+        """
+        ratio = self.get('rebin_ratio')
+        if not ratio:
+            return pd
+        bins = pd.get('bins')
+        bin_width = ratio * self.get('sigma')
+        if bin_width <= np.max(np.diff(bins)) + 1E-10:
+            return pd
+        rebinned, _ = pd.rebin(bin_width=bin_width)
+        return rebinned
 
     def from_pair_data(self, pd: PairData):
         """
         Load some of the run metadata from a PairData object.
         :param pd: PairData object from which metadata are loaded
+        :return: the PairData object the metadata were derived from (rebinned if rebin_ratio is set). Force tables
+        must be built from this object so that they match bin_width, min_dist and max_dist.
         """
+        pd = self.resolve_pair_data(pd)
         name = pd.name
         self.pair_params[name] = PairParams(name)
+        self.columns.invalidate()
 
         # Atoms to be restrained
         self.pair_params[name].set('sites', pd.get('sites'))
@@ -150,17 +271,83 @@ class RunData:
         # Historical distance count filename
         self.pair_params[name].set('historical_data_filename', 'counts_{}.log'.format(name))
 
-        # Calculate the bin width
+        # Store the grid, and the bin width used by the plugin (the finest spacing if the grid is non-uniform)
         bins = pd.get('bins')
-        self.pair_params[name].set('bin_width', bins[1] - bins[0])
+        self.pair_params[name].set('bins', bins)
+        if is_uniform(bins):
+            self.pair_params[name].set('bin_width', bins[1] - bins[0])
+        else:
+            self.pair_params[name].set('bin_width', float(np.min(np.diff(bins))))
 
         # Calculate the min and max distances for turning off the the EBMetaD restraints (at boundaries)
-        min_dist, max_dist = get_min_max(pd.get('distribution'), self.pair_params[name].get('bin_width'))
+        min_dist, max_dist = get_min_max(pd.get('distribution'), bins)
         self.pair_params[name].set('min_dist', min_dist)
         self.pair_params[name].set('max_dist', max_dist)
+        return pd
+
+    def as_deduplicated_dictionary(self):
+        """
+        Same as as_dictionary, except that force tables shared by several pairs (the same table object, see
+        MultiPair.build_force_tables) are stored once under 'force tables', keyed by the name of the first pair using
+        them. Each of those pairs only stores a reference: {'force_table': {'shared': key}}.
+        :return: heirarchical dictionary of metadata
+        """
+        data = self.as_dictionary()
+        if self.fingerprint:
+            data['fingerprint'] = self.fingerprint
+        owners = {}
+        for name, params in data['pair parameters'].items():
+            if 'force_table' in params:
+                owners.setdefault(id(params['force_table']), []).append(name)
+
+        shared = {}
+        for names in owners.values():
+            if len(names) > 1:
+                key = names[0]
+                shared[key] = data['pair parameters'][key]['force_table']
+                for name in names:
+                    params = dict(data['pair parameters'][name])
+                    params['force_table'] = {'shared': key}
+                    data['pair parameters'][name] = params
+        if shared:
+            data['force tables'] = shared
+        return data
 
     def save_config(self, fnm='state.json'):
-        json.dump(self.as_dictionary(), open(fnm, 'w'))
+        dump_json(self.as_deduplicated_dictionary(), fnm)
 
     def load_config(self, fnm='state.json'):
-        self.from_dictionary(json.load(open(fnm)))
+        self.from_dictionary(load_json(fnm))
+
+    def save_state(self, fnm='run_state.json'):
+        """
+        Save only what changes from one run segment to the next: the general parameters and the distance counts.
+        The force tables stay in the file written by save_config, so the cost does not grow with the table sizes.
+        :param fnm: output path.
+        """
+        counts = {}
+        for name, params in self.pair_params.items():
+            if 'distance_counts' in params.get_as_dictionary():
+                counts[name] = params.get('distance_counts')
+        data = {
+            'general parameters': self.general_params.get_as_dictionary(),
+            'distance_counts': counts,
+            'fingerprint': self.fingerprint
+        }
+        dump_json(data, fnm)
+
+    def load_state(self, fnm='run_state.json'):
+        """
+        Apply a state saved by save_state on top of the loaded configuration. A state saved for other inputs or
+        force tables (a different fingerprint) is ignored.
+        :param fnm: path to the state file.
+        :return: True if the state was applied.
+        """
+        data = load_json(fnm)
+        if data.get('fingerprint', {}) != self.fingerprint:
+            return False
+        self.set(**data['general parameters'])
+        for name, counts in data['distance_counts'].items():
+            if name in self.pair_params:
+                self.set(name=name, distance_counts=counts)
+        return True
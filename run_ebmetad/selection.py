@@ -0,0 +1,109 @@
+"""
+Selects the most informative subset of restraints, so that fewer plugins run inside the MD engine.
+All DEER distributions are put on a common distance grid and scored together:
+    information: KL divergence from a uniform distribution over the grid, log(nbins) - entropy (in nats). Narrow,
+                 well-defined distributions carry the most information.
+    width:       standard deviation of the distribution (reported; narrow distributions score high on information)
+    redundancy:  Jensen-Shannon divergence to the closest pair already selected, in units of log 2. Pairs whose
+                 distribution is nearly the same as a selected one add little.
+Pairs are selected greedily by information * redundancy (the first pair by information alone).
+"""
+
+import numpy as np
+from run_ebmetad.convergence import js_divergence
+from run_ebmetad.pair_data import MultiPair
+
+
+def distribution_matrix(multi_pair):
+    """
+    Stack every distribution, normalized, on a common grid: the grid of the pairs if they all share one, otherwise the
+    union of their ranges at the finest spacing (distributions are interpolated as densities).
+    :param multi_pair: MultiPair holding the pair data.
+    :return: (grid, (npairs, nbins) array of distributions)
+    """
+    grids = [np.asarray(pd.get('bins'), dtype=np.float64) for pd in multi_pair]
+    probs = [np.asarray(pd.get('distribution'), dtype=np.float64) for pd in multi_pair]
+    if all(len(grid) == len(grids[0]) and np.array_equal(grid, grids[0]) for grid in grids):
+        grid = grids[0]
+        matrix = np.array(probs)
+    else:
+        step = min(np.min(np.diff(grid)) for grid in grids)
+        lo, hi = min(grid[0] for grid in grids), max(grid[-1] for grid in grids)
+        grid = np.arange(lo, hi + 0.5 * step, step)
+        matrix = np.array([
+            np.interp(grid, pgrid, p / np.gradient(pgrid), left=0., right=0.) for pgrid, p in zip(grids, probs)
+        ])
+    return grid, matrix / np.sum(matrix, axis=1, keepdims=True)
+
+
+def rank_pairs(multi_pair):
+    """
+    Rank all pairs by information content, discounted by redundancy with the pairs ranked before them.
+    :param multi_pair: MultiPair holding the pair data.
+    :return: list of {'name', 'information', 'width', 'redundancy', 'score'}, most informative first.
+    """
+    names = multi_pair.get_names()
+    grid, matrix = distribution_matrix(multi_pair)
+
+    logs = np.log(np.where(matrix > 0, matrix, 1.))
+    information = np.log(matrix.shape[1]) + np.sum(matrix * logs, axis=1)
+    mean = matrix.dot(grid)
+    width = np.sqrt(np.sum(matrix * (grid[None, :] - mean[:, None])**2, axis=1))
+    # All pairwise divergences at once, in units of log 2
+    divergence = js_divergence(matrix[:, None, :], matrix[None, :, :]) / np.log(2)
+
+    ranking = []
+    remaining = np.ones(len(names), dtype=bool)
+    closest = np.ones(len(names))
+    while remaining.any():
+        score = np.where(remaining, information * closest, -np.inf)
+        best = int(np.argmax(score))
+        ranking.append({
+            'name': names[best],
+            'information': float(information[best]),
+            'width': float(width[best]),
+            'redundancy': float(1. - closest[best]),
+            'score': float(score[best])
+        })
+        remaining[best] = False
+        closest = np.minimum(closest, divergence[best])
+    return ranking
+
+
+def select_pairs(multi_pair, n=None, fraction=None, min_score=None):
+    """
+    Names of the most informative pairs, in ranking order.
+    :param multi_pair: MultiPair holding the pair data.
+    :param n: number of pairs to keep.
+    :param fraction: fraction of the pairs to keep (rounded up), if n is not given.
+    :param min_score: also drop the pairs whose score is below this value.
+    :return: list of pair names (a name filter for RunConfig).
+    """
+    ranking = rank_pairs(multi_pair)
+    if n is None and fraction is not None:
+        if not 0 < fraction <= 1:
+            raise ValueError('fraction must be in (0, 1], got {}'.format(fraction))
+        n = int(np.ceil(fraction * len(ranking)))
+    if n is not None:
+        ranking = ranking[:n]
+    if min_score is not None:
+        ranking = [entry for entry in ranking if entry['score'] >= min_score]
+    return [entry['name'] for entry in ranking]
+
+
+def write_selection(multi_pair, names, filename):
+    """
+    Write a reduced pair file containing only the selected pairs.
+    :param multi_pair: MultiPair holding the pair data.
+    :param names: names of the pairs to keep.
+    :param filename: output path.
+    :return: MultiPair of the selected pairs.
+    """
+    data = multi_pair.get_as_single_dataset()
+    missing = [name for name in names if name not in data]
+    if missing:
+        raise ValueError('Unknown pairs: {}'.format(missing))
+    selected = MultiPair()
+    selected.set_from_dictionary({name: data[name] for name in names})
+    selected.write_to_json(filename)
+    return selected
@@ -0,0 +1,95 @@
+"""
+Multi-walker history of distance counts shared by several ensemble members.
+The history lives in a memory-mapped .npy file (pairs x bins), so every walker on a node sees the same pages.
+Writers take a coarse advisory lock (fcntl.flock) on a sidecar lock file; readers that only need a consistent
+snapshot take the same lock for the duration of one copy.
+
+Limitation: histories are only exchanged at segment boundaries. The EBMetaD plugin reads its distance counts when it
+is built and keeps them inside the MD engine, so within a segment each walker only sees its own sampling. A member
+contributes its counts when a segment finishes and picks up the others' at the start of the next one; use
+RunConfig.run_segments with short segments to exchange histories more often.
+"""
+
+import os
+import fcntl
+import tempfile
+from contextlib import contextmanager
+import numpy as np
+
+
+class SharedHistory:
+    def __init__(self, path, names, nbins):
+        """
+        Open the shared history, creating it (initialized with ones, like a fresh member history) if needed.
+        :param path: path to the shared .npy file.
+        :param names: pair names, in the order used for the rows of the history.
+        :param nbins: number of distance bins per pair (the largest pair, if they differ).
+        """
+        self.path = os.path.abspath(path)
+        self.names = list(names)
+        self.nbins = nbins
+        self._lock_path = '{}.lock'.format(self.path)
+
+        with self.lock():
+            if not os.path.exists(self.path):
+                self.__create()
+        self._history = np.load(self.path, mmap_mode='r+')
+        if self._history.shape != (len(self.names), nbins):
+            raise ValueError('Shared history {} has shape {}, expected {}'.format(
+                path, self._history.shape, (len(self.names), nbins)))
+
+    def __create(self):
+        directory = os.path.dirname(self.path)
+        fd, tmp = tempfile.mkstemp(dir=directory, suffix='.npy')
+        os.close(fd)
+        np.save(tmp, np.ones((len(self.names), self.nbins), dtype=np.int64))
+        os.replace(tmp, self.path)
+
+    @contextmanager
+    def lock(self):
+        """
+        Coarse, node-wide lock on the history.
+        """
+        with open(self._lock_path, 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def get(self, name, nbins=None):
+        """
+        :param name: pair name.
+        :param nbins: number of bins to return; defaults to all.
+        :return: a copy of the shared counts for one pair.
+        """
+        with self.lock():
+            return np.array(self._history[self.names.index(name), :nbins])
+
+    def snapshot(self):
+        """
+        Consistent copy of the whole history, e.g. to save between segments.
+        :return: dictionary of pair name -> counts array.
+        """
+        with self.lock():
+            history = np.array(self._history)
+        return {name: history[i] for i, name in enumerate(self.names)}
+
+    def save_snapshot(self, fnm):
+        """
+        Write a snapshot of the history to a standalone .npy file.
+        :param fnm: output path.
+        """
+        with self.lock():
+            np.save(fnm, np.array(self._history))
+
+    def contribute(self, deltas):
+        """
+        Add the counts sampled by one walker to the shared history.
+        :param deltas: dictionary of pair name -> counts sampled since the walker last read the history.
+        """
+        with self.lock():
+            for name, delta in deltas.items():
+                delta = np.asarray(delta, dtype=np.int64)
+                self._history[self.names.index(name), :len(delta)] += delta
+            self._history.flush()
@@ -0,0 +1,173 @@
+"""
+Sensitivity sweeps over the Metadynamics parameters 'w' and 'sigma'.
+Every (w, sigma) combination is computed in a worker process and written to its own .npz file (one array per pair) as
+soon as it is done, and the kernels built for it are released, so memory use is bounded by the parsed pair data plus
+one combination per worker however large the sweep. An index.json file lists the combinations and their files:
+
+output_dir
+├── index.json
+├── w0.1_s0.2.npz
+└── ...
+"""
+
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+from run_ebmetad.counts import file_signature
+from run_ebmetad.metadata import dump_json, load_json
+from run_ebmetad.pair_data import MultiPair
+
+INDEX_FILENAME = 'index.json'
+
+# Pair data already parsed in this (worker) process: (pairs_json, cache) -> (file signature, MultiPair)
+_pairs = {}
+
+
+def combination_key(w, sigma):
+    """
+    :param w: weight, or height, of the Gaussians.
+    :param sigma: width of the Gaussians.
+    :return: the name of a (w, sigma) combination, also used as its file name.
+    """
+    return 'w{}_s{}'.format(w, sigma)
+
+
+def load_pairs(pairs_json, cache=False):
+    """
+    Parse the pair data once per process, and again whenever the file changes.
+    :param pairs_json: path to the pair data.
+    :param cache: read through the binary sidecar cache (see MultiPair.read_from_json).
+    :return: MultiPair
+    """
+    key = (os.path.abspath(pairs_json), cache)
+    signature = file_signature(pairs_json)
+    if key not in _pairs or _pairs[key][0] != signature:
+        multi_pair = MultiPair()
+        multi_pair.read_from_json(pairs_json, cache=cache)
+        _pairs[key] = (signature, multi_pair)
+    return _pairs[key][1]
+
+
+def iter_force_tables(multi_pair, weights, sigmas):
+    """
+    Build the force tables of every pair, one (w, sigma) combination at a time.
+    :param multi_pair: MultiPair holding the pair data.
+    :param weights: list of w values.
+    :param sigmas: list of sigma values.
+    :return: generator of (w, sigma, dictionary of pair name -> force table).
+    """
+    for w in weights:
+        for s in sigmas:
+            tables = multi_pair.build_force_tables(w, s)
+            # Kernels are specific to one sigma; keeping them would grow the process by one per combination
+            multi_pair.kernel_cache.clear()
+            yield w, s, tables
+
+
+def write_combination(output_dir, w, sigma, tables):
+    """
+    Write the force tables of one combination to output_dir/<key>.npz, atomically.
+    :param output_dir: sweep output directory.
+    :param w: weight, or height, of the Gaussians.
+    :param sigma: width of the Gaussians.
+    :param tables: dictionary of pair name -> force table.
+    :return: file name, relative to output_dir.
+    """
+    fnm = '{}.npz'.format(combination_key(w, sigma))
+    path = os.path.join(output_dir, fnm)
+    tmp = '{}.tmp'.format(path)
+    with open(tmp, 'wb') as f:
+        np.savez(f, **tables)
+    os.replace(tmp, path)
+    return fnm
+
+
+def load_combination(output_dir, w, sigma):
+    """
+    :param output_dir: sweep output directory.
+    :param w: weight, or height, of the Gaussians.
+    :param sigma: width of the Gaussians.
+    :return: dictionary of pair name -> force table.
+    """
+    with np.load(os.path.join(output_dir, '{}.npz'.format(combination_key(w, sigma)))) as data:
+        return {name: data[name] for name in data.files}
+
+
+def sweep_combination(multi_pair, output_dir, w, sigma):
+    """
+    Build and write the force tables of one combination.
+    :param multi_pair: MultiPair holding the pair data.
+    :param output_dir: sweep output directory.
+    :param w: weight, or height, of the Gaussians.
+    :param sigma: width of the Gaussians.
+    :return: index entry {'key', 'w', 'sigma', 'file'}.
+    """
+    fnm = write_combination(output_dir, w, sigma, multi_pair.build_force_tables(w, sigma))
+    multi_pair.kernel_cache.clear()
+    return {'key': combination_key(w, sigma), 'w': w, 'sigma': sigma, 'file': fnm}
+
+
+def _sweep_combination(pairs_json, cache, output_dir, w, sigma):
+    return sweep_combination(load_pairs(pairs_json, cache), output_dir, w, sigma)
+
+
+def combinations(weights, sigmas):
+    """
+    :param weights: list of w values.
+    :param sigmas: list of sigma values.
+    :return: list of every (w, sigma) combination, in sweep order.
+    """
+    return [(w, s) for w in weights for s in sigmas]
+
+
+def write_index(output_dir, pairs_json, names, entries, weights, sigmas):
+    """
+    Write index.json, with the combinations in sweep order whatever order they completed in.
+    :param output_dir: sweep output directory.
+    :param pairs_json: path to the pair data.
+    :param names: pair names.
+    :param entries: index entries (see sweep_combination), in any order.
+    :param weights: list of w values.
+    :param sigmas: list of sigma values.
+    :return: the index.
+    """
+    order = {combination_key(w, s): i for i, (w, s) in enumerate(combinations(weights, sigmas))}
+    entries = sorted(entries, key=lambda entry: order[entry['key']])
+    index = {'pairs_json': pairs_json, 'names': names, 'combinations': entries}
+    dump_json(index, os.path.join(output_dir, INDEX_FILENAME), indent=2)
+    return index
+
+
+def run_sweep(pairs_json, weights, sigmas, output_dir, max_workers=None, cache=False):
+    """
+    Compute the force tables of every (w, sigma) combination in a process pool, streaming each combination to disk as
+    it completes.
+    :param pairs_json: path to the pair data.
+    :param weights: list of w values.
+    :param sigmas: list of sigma values.
+    :param output_dir: sweep output directory. Created if needed.
+    :param max_workers: size of the process pool.
+    :param cache: read the pair data through the binary sidecar cache.
+    :return: the index, {'pairs_json', 'names', 'combinations': [{'key', 'w', 'sigma', 'file'}, ...]}.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    pairs_json = os.path.abspath(pairs_json)
+    names = load_pairs(pairs_json, cache).get_names()
+
+    entries = []
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(_sweep_combination, pairs_json, cache, output_dir, w, s)
+            for w, s in combinations(weights, sigmas)
+        ]
+        for future in as_completed(futures):
+            entries.append(future.result())
+    return write_index(output_dir, pairs_json, names, entries, weights, sigmas)
+
+
+def load_index(output_dir):
+    """
+    :param output_dir: sweep output directory.
+    :return: the index written by run_sweep.
+    """
+    return load_json(os.path.join(output_dir, INDEX_FILENAME))
@@ -0,0 +1,27 @@
+from run_ebmetad.aggregate import CountsAggregator
+import numpy as np
+import os
+
+
+def test_aggregate(tmpdir, multi_pair_data):
+    names = multi_pair_data.get_names()
+    for member in range(3):
+        os.mkdir('{}/mem_{}'.format(tmpdir, member))
+        for name in names:
+            np.savetxt('{}/mem_{}/counts_{}.log'.format(tmpdir, member, name), np.full(70, member + 1), fmt='%d')
+
+    aggregator = CountsAggregator(tmpdir, multi_pair_data, max_workers=2)
+    counts = aggregator.aggregate()
+    assert (counts.shape == (3, len(names), 70))
+    assert (np.all(aggregator.summed() == 6))
+
+    # Only the changed file should be re-read; the result must reflect it
+    np.savetxt('{}/mem_2/counts_{}.log'.format(tmpdir, names[0]), np.full(70, 10), fmt='%d')
+    counts = aggregator.aggregate()
+    assert (np.all(counts[2, 0] == 10))
+    assert (np.all(counts[2, 1] == 3))
+
+    aggregator.save('{}/ensemble_counts.npz'.format(tmpdir))
+    loaded, members, loaded_names = CountsAggregator.load('{}/ensemble_counts.npz'.format(tmpdir))
+    assert (np.array_equal(loaded, counts))
+    assert (members == [0, 1, 2] and loaded_names == names)
@@ -0,0 +1,50 @@
+from run_ebmetad.bias import BiasEvaluator, integrate_force_table, iter_chunks
+import numpy as np
+
+
+def test_integrate_force_table(multi_pair_data):
+    """
+    The potential of every column is the Gaussian w / V / (p_j + 0.1) * exp(-(d - d_j)^2 / 2 sigma^2), and its
+    derivative is minus the force (the table entries times the distance).
+    """
+    pd = multi_pair_data[0]
+    bins = np.array(pd.get('bins'))
+    probs = np.array(pd.get('distribution')) / np.sum(pd.get('distribution'))
+    amplitudes = pd.prefactor(w=10, sigma=0.2) * 0.2**2 / (probs + 0.1)
+    analytic = amplitudes[None, :] * np.exp(-(bins[:, None] - bins[None, :])**2 / (2 * 0.2**2))
+    analytic[:, bins == 0] = 0  # a history at zero distance contributes nothing (see build_kernel)
+
+    potential_table = integrate_force_table(pd.build_force_table(w=10, sigma=0.2), bins, 0.2)
+    assert (np.allclose(potential_table, analytic, rtol=1e-6, atol=0))
+    assert (np.argmax(potential_table[:, 30]) == 30)
+    assert (np.isclose(potential_table[30, 30], 3907.9, rtol=1e-4))
+
+    evaluator = pd.bias_evaluator(w=10, sigma=0.2, counts=np.eye(70)[30])
+    assert (np.allclose(evaluator.force(bins[1:-1]), -np.gradient(potential_table[:, 30], bins)[1:-1],
+                        atol=0.1 * np.max(np.abs(evaluator.force_profile()))))
+
+
+def test_bias_evaluator(multi_pair_data):
+    pd = multi_pair_data[0]
+    counts = np.ones(70)
+    counts[30] = 100
+    evaluator = pd.bias_evaluator(w=10, sigma=0.2, counts=counts)
+
+    # On the grid, interpolation reproduces the profiles exactly
+    bins = np.array(pd.get('bins'))
+    assert (np.allclose(evaluator.force(bins), evaluator.force_profile()))
+    assert (np.allclose(evaluator.bias(bins), pd.build_potential_table(w=10, sigma=0.2).dot(counts)))
+
+    # Chunked and streamed evaluation agree with a single call
+    distances = np.random.uniform(0.5, 6.5, size=1000)
+    bias = evaluator.bias(distances)
+    assert (np.allclose(evaluator.bias(distances, chunk_size=64), bias))
+    assert (np.allclose(np.concatenate(list(evaluator.bias_stream(iter_chunks(distances, 100)))), bias))
+
+
+def test_run_data_bias_evaluator(run_data, multi_pair_data):
+    pd = multi_pair_data[0]
+    run_data.set(name=pd.name, force_table=pd.build_force_table(), distance_counts=[1] * 70)
+    evaluator = run_data.bias_evaluator(pd.name)
+    assert (isinstance(evaluator, BiasEvaluator))
+    assert (np.isfinite(evaluator.bias(3.0)))
@@ -0,0 +1,25 @@
+from run_ebmetad.bins import BinIndex, is_uniform
+from run_ebmetad.run_data import RunData, get_min_max
+import numpy as np
+
+
+def test_bin_index():
+    index = BinIndex([0., 1., 2., 4., 8.])
+    assert (not index.uniform)
+    assert (index.edges.tolist() == [0., 1., 2., 4., 8., 12.])
+    assert (index.lookup([-1., 0.5, 1., 3.9, 4., 11., 20.]).tolist() == [0, 0, 1, 2, 3, 4, 4])
+    assert (is_uniform(np.arange(0, 7, 0.1)))
+
+
+def test_non_uniform_pair(multi_pair_data):
+    """
+    min/max distances come from the actual grid, not from index * bin_width.
+    """
+    pd, _ = multi_pair_data[0].rebin(bins=[0., 1., 2., 2.5, 3., 3.5, 4., 5., 6.])
+    run_data = RunData()
+    run_data.from_pair_data(pd)
+    min_dist, max_dist = get_min_max(pd.get('distribution'), pd.get('bins'))
+    assert (run_data.get('min_dist', name=pd.name) == min_dist)
+    assert (min_dist in pd.get('bins') and max_dist in pd.get('bins'))
+    assert (run_data.get('bin_width', name=pd.name) == 0.5)
+    assert (run_data.bin_index(pd.name).lookup(2.7) == 3)
@@ -0,0 +1,63 @@
+from run_ebmetad.convergence import ConvergenceMonitor, js_divergence, kl_divergence
+from run_ebmetad.counts import CountsFile
+import numpy as np
+import os
+
+
+def test_divergences():
+    p = np.array([0.1, 0.4, 0.5])
+    assert (np.isclose(kl_divergence(p, p), 0))
+    assert (np.isclose(js_divergence(p, p), 0))
+    assert (js_divergence(p, [1, 0, 0]) <= np.log(2))
+
+
+def test_monitor(tmpdir, multi_pair_data):
+    """
+    Writes counts for two members and checks that the monitor picks up appended snapshots.
+    """
+    names = multi_pair_data.get_names()
+    for member in [0, 1]:
+        os.mkdir('{}/mem_{}'.format(tmpdir, member))
+        for name in names:
+            np.savetxt('{}/mem_{}/counts_{}.log'.format(tmpdir, member, name), np.ones(70, dtype=int), fmt='%d')
+
+    monitor = ConvergenceMonitor(tmpdir, multi_pair_data, output='{}/convergence.log'.format(tmpdir))
+    record = monitor.poll()
+    assert (record['pairs'][names[0]]['samples'] == 140)
+    assert (not monitor.is_converged(tolerance=0.01, window=1))
+
+    # Append a snapshot that matches the target for one pair: its divergence should drop
+    target = np.array(multi_pair_data[0].get('distribution'))
+    with open('{}/mem_0/counts_{}.log'.format(tmpdir, names[0]), 'w') as f:
+        f.write(' '.join(['1'] * 70) + '\n')
+    monitor.poll()
+    with open('{}/mem_0/counts_{}.log'.format(tmpdir, names[0]), 'a') as f:
+        f.write(' '.join(str(int(c)) for c in np.round(target * 1E6)) + '\n')
+    record = monitor.poll()
+    assert (record['pairs'][names[0]]['js'] < monitor.history[0]['pairs'][names[0]]['js'])
+    assert (len(open('{}/convergence.log'.format(tmpdir)).readlines()) == 1 + 3 * (len(names) + 1))
+
+
+def test_counts_file(tmpdir):
+    """
+    Snapshot rows are tailed; single-histogram files written by np.savetxt are re-read when they change.
+    """
+    fnm = '{}/counts_A.log'.format(tmpdir)
+    np.savetxt(fnm, np.ones(5, dtype=int), fmt='%d')
+    counts = CountsFile(fnm)
+    assert (counts.poll())
+    assert (not counts.poll())
+    np.savetxt(fnm, [1, 2, 3, 4, 5], fmt='%d')
+    os.utime(fnm, ns=(0, 0))
+    assert (counts.poll())
+    assert (counts.counts.tolist() == [1, 2, 3, 4, 5])
+
+    rows = '{}/counts_B.log'.format(tmpdir)
+    with open(rows, 'w') as f:
+        f.write('1 1 1\n')
+    counts = CountsFile(rows)
+    counts.poll()
+    with open(rows, 'a') as f:
+        f.write('1 2 3\n')
+    assert (counts.poll())
+    assert (counts.counts.tolist() == [1, 2, 3])
@@ -1,5 +1,7 @@
-from run_ebmetad.directory_helper import DirectoryHelper
+import pytest
+from run_ebmetad.directory_helper import DirectoryHelper, check_ensemble, provision_ensemble
 import os
+import stat
 
 
 def test_directory(tmpdir):
@@ -16,3 +18,59 @@ def test_directory(tmpdir):
     assert (os.getcwd() == '{}/mem_0'.format(top_dir))
 
     os.chdir(my_home)
+
+
+def test_stage(tmpdir):
+    """
+    Checks that a member staged on scratch is synced back, copying only the files that changed.
+    :param tmpdir: temporary pytest directory
+    """
+    top_dir = str(tmpdir.mkdir("top_directory"))
+    scratch_dir = str(tmpdir.mkdir("scratch"))
+    dir_helper = DirectoryHelper(top_dir, 0, scratch_dir=scratch_dir)
+    dir_helper.build_working_dir()
+    with open('{}/mem_0/input.txt'.format(top_dir), 'w') as f:
+        f.write('input\n')
+
+    sync = dir_helper.stage(sync_interval=3600.)
+    try:
+        assert (os.path.exists('{}/mem_0/input.txt'.format(scratch_dir)))
+        with open('{}/mem_0/counts_A.log'.format(scratch_dir), 'w') as f:
+            f.write('1 2 3\n')
+        assert (sync.sync() == ['counts_A.log'])
+        assert (sync.sync() == [])
+        with open('{}/mem_0/counts_A.log'.format(scratch_dir), 'a') as f:
+            f.write('2 3 4\n')
+    finally:
+        copied = sync.stop()
+    assert (copied == ['counts_A.log'])
+    with open('{}/mem_0/counts_A.log'.format(top_dir)) as f:
+        assert (f.read() == '1 2 3\n2 3 4\n')
+
+
+def test_stage_requires_scratch(tmpdir):
+    with pytest.raises(ValueError):
+        DirectoryHelper(str(tmpdir), 0).stage()
+
+
+@pytest.mark.parametrize('link', ['hard', 'symlink'])
+def test_provision_ensemble(tmpdir, data_dir, link):
+    top_dir = '{}/ensemble'.format(tmpdir)
+    pairs_json = '{}/pair_data.json'.format(data_dir)
+    member_dirs = provision_ensemble(top_dir, 4, shared_inputs=[pairs_json], link=link)
+    assert (member_dirs == ['{}/mem_{}'.format(top_dir, member) for member in range(4)])
+    for member_dir in member_dirs:
+        assert (os.path.samefile('{}/pair_data.json'.format(member_dir), '{}/pair_data.json'.format(top_dir)))
+    assert (check_ensemble(top_dir, range(4), ['pair_data.json']) == {})
+
+    # The shared copy is read-only through every link (checked on the mode, since root may write anyway)
+    write_bits = stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH
+    for member_dir in member_dirs:
+        assert (not os.stat('{}/pair_data.json'.format(member_dir)).st_mode & write_bits)
+    assert (os.stat(pairs_json).st_mode & stat.S_IWUSR)
+
+    # Provisioning is idempotent, and repairs broken members
+    os.remove('{}/pair_data.json'.format(member_dirs[2]))
+    assert (check_ensemble(top_dir, range(4), ['pair_data.json']) == {2: ['pair_data.json']})
+    provision_ensemble(top_dir, 4, shared_inputs=[pairs_json], link=link)
+    assert (check_ensemble(top_dir, range(4), ['pair_data.json']) == {})
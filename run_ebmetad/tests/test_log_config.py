@@ -0,0 +1,37 @@
+from run_ebmetad.log_config import member_logger, stop_logging
+import logging
+import logging.handlers
+
+
+def test_member_logger(tmpdir):
+    fnm = '{}/member.log'.format(tmpdir)
+    logger = member_logger(99, log_level='INFO', filename=fnm, console=False)
+    try:
+        # A second call must not add handlers, only change the level
+        assert (member_logger(99, log_level=logging.WARNING) is logger)
+        assert (len(logger.handlers) == 1)
+        assert (isinstance(logger.handlers[0], logging.handlers.QueueHandler))
+        logger.info('hidden')
+        logger.warning('shown')
+    finally:
+        stop_logging(99)
+    assert (not logger.handlers)
+    with open(fnm) as f:
+        lines = f.readlines()
+    assert (len(lines) == 1)
+    assert (lines[0].rstrip().endswith('WARNING - shown'))
+
+
+def test_member_logger_root_handler(tmpdir, capsys):
+    """
+    With a handler on the root logger (e.g. from logging.basicConfig), every message is still printed only once.
+    """
+    root_handler = logging.StreamHandler()
+    logging.getLogger().addHandler(root_handler)
+    logger = member_logger(98, log_level='INFO', filename='{}/member.log'.format(tmpdir))
+    try:
+        logger.info('once')
+    finally:
+        stop_logging(98)
+        logging.getLogger().removeHandler(root_handler)
+    assert (capsys.readouterr().err.count('once') == 1)
@@ -0,0 +1,67 @@
+from run_ebmetad.mpi import SerialComm, distribute, mpi_setup_ensemble, mpi_sweep
+from run_ebmetad.run_data import RunData
+from run_ebmetad.run_config import RunConfig
+from run_ebmetad.sweep import INDEX_FILENAME, combination_key, combinations, load_combination, load_index
+import numpy as np
+import os
+import pytest
+
+
+class FakeRank(SerialComm):
+    def __init__(self, rank, size):
+        self.rank = rank
+        self.size = size
+
+
+def test_distribute():
+    items = list(range(10))
+    shares = [distribute(items, FakeRank(rank, 4)) for rank in range(4)]
+    assert (sorted(sum(shares, [])) == items)
+    assert (shares[1] == [1, 5, 9])
+
+
+def test_mpi_sweep(tmpdir, data_dir, multi_pair_data):
+    output_dir = '{}/sweep'.format(tmpdir)
+    index = mpi_sweep('{}/pair_data.json'.format(data_dir), [0.1, 1.], [0.2], output_dir, comm=SerialComm())
+    assert (load_index(output_dir) == index)
+    tables = load_combination(output_dir, 0.1, 0.2)
+    for pd in multi_pair_data:
+        assert (np.array_equal(tables[pd.name], np.array(pd.build_force_table(w=0.1, sigma=0.2), dtype=np.float32)))
+
+
+def test_mpi_setup_ensemble(tmpdir, data_dir, multi_pair_data):
+    ensemble_dir = '{}/ensemble'.format(tmpdir)
+    pairs_json = '{}/pair_data.json'.format(data_dir)
+    general_params = {'w': 1., 'sigma': 0.4}
+    assert (mpi_setup_ensemble(ensemble_dir, pairs_json, 3, comm=SerialComm(), general_params=general_params,
+                               shared_inputs=[pairs_json]) == [0, 1, 2])
+    for member in range(3):
+        run_data = RunData()
+        run_data.load_config('{}/mem_{}/run_config.json'.format(ensemble_dir, member))
+        assert (run_data.get('ensemble_num') == member)
+        assert (run_data.fingerprint['general_params'] == general_params)
+        for pd in multi_pair_data:
+            expected = np.array(pd.build_force_table(w=1., sigma=0.4), dtype=np.float32)
+            assert (np.array_equal(np.array(run_data.get('force_table', name=pd.name), dtype=np.float32), expected))
+
+    # A member started in resume mode uses the prepared configuration as is
+    rc = RunConfig(tpr='{}/topol.tpr'.format(data_dir), ensemble_dir=ensemble_dir, ensemble_num=2,
+                   pairs_json=pairs_json, resume=True, general_params=general_params)
+    assert (rc.resumed)
+
+
+def test_mpi_world(tmpdir, data_dir):
+    """
+    Under mpirun, e.g. mpirun -n 2 python -m pytest run_ebmetad/tests/test_mpi.py, every rank writes its share of the
+    combinations into rank 0's directory (each rank has its own tmpdir).
+    """
+    MPI = pytest.importorskip('mpi4py.MPI')
+    comm = MPI.COMM_WORLD
+    output_dir = comm.bcast('{}/sweep'.format(tmpdir), root=0)
+    weights, sigmas = [0.1, 1.], [0.2, 0.4]
+    index = mpi_sweep('{}/pair_data.json'.format(data_dir), weights, sigmas, output_dir, comm=comm)
+    keys = [combination_key(w, s) for w, s in combinations(weights, sigmas)]
+    assert ([combination['key'] for combination in index['combinations']] == keys)
+    if comm.rank == 0:
+        files = [fnm for fnm in os.listdir(output_dir) if fnm != INDEX_FILENAME]
+        assert (sorted(files) == sorted('{}.npz'.format(key) for key in keys))
@@ -0,0 +1,26 @@
+from run_ebmetad.orchestrator import EnsembleOrchestrator
+import os
+import sys
+
+
+def stand_in(member, attempt):
+    """
+    Stand-in engine: member 1 fails on its first launch, after a delay; every other launch succeeds.
+    """
+    failing = member == 1 and attempt == 0
+    code = 'import os, time; print("member {} attempt {} in", os.getcwd()); time.sleep({}); raise SystemExit({})'
+    return [sys.executable, '-c', code.format(member, attempt, 0.5 if failing else 0, int(failing))]
+
+
+def test_orchestrator(tmpdir):
+    orchestrator = EnsembleOrchestrator('topol.tpr', str(tmpdir), 'pair_data.json', range(3), nsteps=100,
+                                        max_concurrent=2, command=stand_in)
+    results = orchestrator.run()
+    assert ([result['returncode'] for result in results] == [0, 0, 0])
+    assert ([result['attempts'] for result in results] == [1, 2, 1])
+    assert (all(result['steps_per_second'] > 0 for result in results))
+    # The failed first launch of member 1 counts towards its wall time, not its throughput
+    assert (results[1]['steps_per_second'] > 100 / results[1]['wall_time'])
+    log = open('{}/mem_1/orchestrator.log'.format(tmpdir)).read()
+    assert ('member 1 attempt 0' in log and 'member 1 attempt 1' in log)
+    assert ('in {}'.format(os.path.realpath('{}/mem_1'.format(tmpdir))) in log)
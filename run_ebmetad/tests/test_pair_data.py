@@ -1,5 +1,10 @@
-from run_ebmetad.pair_data import PairData
+from run_ebmetad.pair_data import PairData, MultiPair, KernelCache, entropy, read_sidecar, sidecar_filename
+from run_ebmetad.run_data import RunData
+import numpy as np
+import json
+import os
 import pytest
+import tracemalloc
 
 
 def test_pair_data(multi_pair_data, raw_pair_data):
@@ -13,3 +18,186 @@ def test_pair_data(multi_pair_data, raw_pair_data):
     for name in multi_pair_data.get_names():
         assert (type(
             multi_pair_data[multi_pair_data.name_to_id(name)]) == PairData)
+
+
+def reference_force_table(pd, w, sigma):
+    """
+    The original element-by-element force table loop, kept as a reference for the vectorized builders.
+    """
+    dists = pd.get('bins')
+    probs = pd.get('distribution')
+    nbins = len(probs)
+    force_table = np.zeros(shape=(nbins, nbins), dtype=np.float32)
+    probs = np.divide(probs, np.sum(probs))
+    pf = w / np.exp(entropy(probs)) / sigma**2
+    for i in range(nbins):
+        for j in range(nbins):
+            exponent = -(dists[i] - dists[j])**2 / sigma**2 / 2
+            deer = 1. / (probs[j] + 0.1)
+            if 0 not in [dists[i], dists[j]]:
+                force_table[i, j] = pf * deer * (1. - dists[j] / dists[i]) * np.exp(exponent)
+    return force_table
+
+
+def test_force_table_reference(multi_pair_data):
+    """
+    The vectorized builders multiply in a different order than the original loop, so they agree with it to float32
+    rounding; the per-pair and batched builders use the same operations and agree exactly.
+    """
+    tables = multi_pair_data.build_force_tables(w=10, sigma=0.2)
+    for pd in multi_pair_data:
+        reference = reference_force_table(pd, w=10, sigma=0.2)
+        table = np.array(pd.build_force_table(w=10, sigma=0.2), dtype=np.float32)
+        assert (np.allclose(table, reference, rtol=1E-6, atol=0))
+        assert (np.array_equal(tables[pd.name], table))
+
+
+def test_kernel_cache(multi_pair_data):
+    """
+    Pairs on the same grid should share one kernel, and the cached tables should match the uncached ones.
+    """
+    cache = KernelCache()
+    for pd in multi_pair_data:
+        assert (pd.build_force_table(w=10, sigma=0.2, kernel_cache=cache) == pd.build_force_table(w=10, sigma=0.2))
+    assert (len(cache) == 1)
+
+
+def test_batched_force_tables(multi_pair_data):
+    """
+    The batched tables should be views into one buffer and match the per-pair tables.
+    """
+    tables = multi_pair_data.build_force_tables(w=10, sigma=0.2)
+    for pd in multi_pair_data:
+        assert (tables[pd.name].tolist() == pd.build_force_table(w=10, sigma=0.2))
+    assert (len({id(table.base) for table in tables.values()}) == 1)
+
+
+def test_blocked_force_tables(raw_pair_data):
+    """
+    A tiny memory budget makes the batched builder fill its buffers in blocks of rows; the tables must not change,
+    also for pairs with the same number of bins on different grids.
+    """
+    shifted = dict(raw_pair_data['052_210'], bins=[d + 0.05 for d in raw_pair_data['052_210']['bins']])
+    multi_pair = MultiPair()
+    multi_pair.set_from_dictionary(dict(raw_pair_data, shifted=shifted))
+    reference = multi_pair.build_force_tables(w=10, sigma=0.2)
+    blocked = multi_pair.build_force_tables(w=10, sigma=0.2, max_memory=4096)
+    for pd in multi_pair:
+        assert (np.array_equal(blocked[pd.name], reference[pd.name]))
+        assert (np.array_equal(blocked[pd.name], np.array(pd.build_force_table(w=10, sigma=0.2), dtype=np.float32)))
+
+
+def test_blocked_force_table(multi_pair_data, tmpdir):
+    """
+    A tiny memory budget forces many blocks; both the in-memory and the memory-mapped tables must match.
+    """
+    pd = multi_pair_data[0]
+    reference = pd.build_force_table(w=10, sigma=0.2)
+    assert (pd.build_force_table_blocked(w=10, sigma=0.2, max_memory=4096).tolist() == reference)
+    fnm = '{}/force_table.npy'.format(tmpdir)
+    pd.build_force_table_blocked(w=10, sigma=0.2, max_memory=4096, filename=fnm)
+    assert (np.load(fnm).tolist() == reference)
+
+
+@pytest.mark.parametrize('max_memory', [2**22, 2**25])
+def test_force_table_memory_budget(max_memory):
+    """
+    Apart from the float32 tables themselves, the builders stay within max_memory, with or without the kernel cache
+    (2**25 bytes holds the kernels of both grids). The slack covers the per-bin vectors and the python objects.
+    """
+    bins = np.round(np.arange(1000) * 0.01, 10)
+    distribution = np.exp(-(bins - 5)**2 / 2)
+    multi_pair = MultiPair()
+    multi_pair.set_from_dictionary({
+        'a': {'sites': [1, 2], 'bins': bins.tolist(), 'distribution': distribution.tolist()},
+        'b': {'sites': [3, 4], 'bins': bins.tolist(), 'distribution': (distribution + 0.01).tolist()},
+        'c': {'sites': [5, 6], 'bins': (bins + 0.005).tolist(), 'distribution': distribution.tolist()}
+    })
+    slack = 2**19
+    table_bytes = 4 * 1000 * 1000
+
+    tracemalloc.start()
+    try:
+        tables = multi_pair.build_force_tables(w=10, sigma=0.2, max_memory=max_memory)
+        assert (tracemalloc.get_traced_memory()[1] <= 3 * table_bytes + max_memory + slack)
+    finally:
+        tracemalloc.stop()
+    del tables
+
+    tracemalloc.start()
+    try:
+        multi_pair[0].build_force_table_blocked(w=10, sigma=0.2, max_memory=max_memory)
+        assert (tracemalloc.get_traced_memory()[1] <= table_bytes + max_memory + slack)
+    finally:
+        tracemalloc.stop()
+    assert (len(multi_pair.kernel_cache) == (2 if max_memory == 2**25 else 0))
+
+
+def test_deduplicated_force_tables(raw_pair_data, tmpdir):
+    """
+    Identical pairs share a single table in memory and a single entry in the saved run config.
+    """
+    raw_pair_data['196_228_copy'] = dict(raw_pair_data['196_228'], name='196_228_copy')
+    json.dump(raw_pair_data, open('{}/pair_data.json'.format(tmpdir), 'w'))
+    multi_pair = MultiPair()
+    multi_pair.read_from_json('{}/pair_data.json'.format(tmpdir))
+    assert (multi_pair.fingerprint(0) == multi_pair.fingerprint(3))
+
+    tables = multi_pair.build_force_tables(w=10, sigma=0.2)
+    assert (tables['196_228'] is tables['196_228_copy'])
+    assert (tables['052_210'] is not tables['196_228'])
+
+    run_data = RunData()
+    for pd in multi_pair:
+        run_data.from_pair_data(pd)
+        run_data.set(name=pd.name, force_table=tables[pd.name])
+    run_data.save_config('{}/run_config.json'.format(tmpdir))
+    saved = json.load(open('{}/run_config.json'.format(tmpdir)))
+    assert (list(saved['force tables'].keys()) == ['196_228'])
+    assert (saved['pair parameters']['196_228_copy']['force_table'] == {'shared': '196_228'})
+
+    loaded = RunData()
+    loaded.load_config('{}/run_config.json'.format(tmpdir))
+    assert (loaded.get('force_table', name='196_228_copy') == tables['196_228'].tolist())
+    assert (loaded.get('force_table', name='052_210') == tables['052_210'].tolist())
+
+
+def test_sidecar_cache(data_dir, tmpdir):
+    """
+    The first cached read writes a sidecar; later reads come from it and give the same pair data.
+    """
+    fnm = '{}/pair_data.json'.format(tmpdir)
+    json.dump(json.load(open('{}/pair_data.json'.format(data_dir))), open(fnm, 'w'))
+    reference = MultiPair()
+    reference.read_from_json(fnm)
+
+    first = MultiPair()
+    first.read_from_json(fnm, cache=True)
+    assert (os.path.exists(sidecar_filename(fnm)))
+    assert (read_sidecar(fnm) == reference.get_as_single_dataset())
+
+    second = MultiPair()
+    second.read_from_json(fnm, cache=True)
+    assert (second.get_as_single_dataset() == reference.get_as_single_dataset())
+
+    # A changed json file invalidates the sidecar
+    json.dump({}, open(fnm, 'w'))
+    assert (read_sidecar(fnm) is None)
+
+
+def test_rebin(multi_pair_data):
+    """
+    Rebinning conserves probability mass and shrinks the force table.
+    """
+    pd = multi_pair_data[0]
+    coarse, report = pd.rebin(bin_width=0.2)
+    assert (np.isclose(np.sum(coarse.get('distribution')), np.sum(pd.get('distribution'))))
+    assert (report['nbins_after'] == 35 and report['table_bytes_after'] == report['table_bytes_before'] // 4)
+    assert (0 < report['error'] < 0.1)
+    assert (len(coarse.build_force_table(w=10, sigma=0.2)) == 35)
+
+    _, report = pd.rebin(bin_width=0.1)
+    assert (np.isclose(report['error'], 0))
+
+    uneven, _ = pd.rebin(bins=[0, 1, 2, 2.5, 3, 3.5, 4, 5, 6])
+    assert (np.isclose(np.sum(uneven.get('distribution')), np.sum(pd.get('distribution'))))
@@ -0,0 +1,70 @@
+from run_ebmetad.reweight import KT_300K, read_distance_chunks, reweight_ensemble, reweight_member
+import numpy as np
+import os
+
+
+def test_read_distance_chunks(tmpdir):
+    distances = np.random.uniform(1, 6, size=(25, 3))
+    np.save('{}/distances.npy'.format(tmpdir), distances)
+    np.savetxt('{}/distances.xvg'.format(tmpdir), distances, header='@ title', comments='')
+    for fnm in ['distances.npy', 'distances.xvg']:
+        chunks = list(read_distance_chunks('{}/{}'.format(tmpdir, fnm), chunk_size=10))
+        assert ([len(chunk) for chunk in chunks] == [10, 10, 5])
+        assert (np.allclose(np.concatenate(chunks), distances))
+
+
+def test_unbiased_histogram(run_data, tmpdir):
+    """
+    With zero force tables, reweighting reduces to a plain histogram of the sampled bins.
+    """
+    names = list(run_data.pair_params.keys())
+    for name in names:
+        run_data.set(name=name, force_table=np.zeros((70, 70)).tolist())
+    distances = np.random.uniform(1, 6, size=(200, len(names)))
+    np.save('{}/distances.npy'.format(tmpdir), distances)
+    histograms = reweight_member(run_data, '{}/distances.npy'.format(tmpdir), chunk_size=64)
+    expected = np.bincount(np.floor(distances[:, 0] / 0.1 + 1E-9).astype(int), minlength=70) / 200.
+    assert (np.allclose(histograms[names[0]].distribution(), expected))
+
+
+def test_evolving_weights(run_data, multi_pair_data, tmpdir):
+    """
+    Each frame is weighted by exp(V / kT), with V the bias of the history counted before it (every count_stride
+    frames), whatever the chunk size.
+    """
+    pd = multi_pair_data[0]
+    names = list(run_data.pair_params.keys())
+    for name in names:
+        run_data.set(name=name, force_table=pd.build_force_table(w=0.01, sigma=0.2))
+    distances = np.random.uniform(2, 4, size=(12, len(names)))
+    np.save('{}/distances.npy'.format(tmpdir), distances)
+
+    potential_table = pd.build_potential_table(w=0.01, sigma=0.2)
+    counts = np.ones(70)
+    expected = np.zeros(70)
+    for frame, distance in enumerate(distances[:, 0]):
+        i = int(np.floor(distance / 0.1 + 1E-9))
+        expected[i] += np.exp(potential_table[i].dot(counts) / KT_300K)
+        if frame % 3 == 0:
+            counts[i] += 1
+
+    for chunk_size in [1, 5, 12]:
+        histograms = reweight_member(run_data, '{}/distances.npy'.format(tmpdir), chunk_size=chunk_size,
+                                     count_stride=3)
+        histogram = histograms[names[0]]
+        assert (np.allclose(histogram.hist * np.exp(histogram.log_scale), expected))
+
+
+def test_reweight_ensemble(run_data, multi_pair_data, tmpdir):
+    names = list(run_data.pair_params.keys())
+    for pd in multi_pair_data:
+        run_data.set(name=pd.name, force_table=pd.build_force_table(w=0.1, sigma=0.2))
+    for member in range(2):
+        os.mkdir('{}/mem_{}'.format(tmpdir, member))
+        run_data.save_config('{}/mem_{}/run_config.json'.format(tmpdir, member))
+        np.save('{}/mem_{}/distances.npy'.format(tmpdir, member), np.random.uniform(2, 5, size=(300, len(names))))
+
+    distributions = reweight_ensemble(tmpdir, chunk_size=100, max_workers=2)
+    assert (set(distributions.keys()) == set(names))
+    for distribution in distributions.values():
+        assert (np.isclose(np.sum(distribution), 1.))
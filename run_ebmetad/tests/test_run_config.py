@@ -1,4 +1,6 @@
 from run_ebmetad.plugin_configs import EBMetaDPluginConfig
+from run_ebmetad.run_config import RunConfig
+import numpy as np
 import os
 import pytest
 
@@ -15,3 +17,114 @@ def test_run(rc):
     root_dir = os.path.abspath(os.getcwd())
     rc.run(nsteps=10)
     os.chdir(root_dir)
+
+
+def test_run_segments(rc):
+    root_dir = os.path.abspath(os.getcwd())
+    timings = rc.run_segments(2, nsteps=10)
+    os.chdir(root_dir)
+    assert ([timing['segment'] for timing in timings] == [0, 1])
+    assert (all(timing['overhead'] >= 0 for timing in timings))
+    # Between segments only the counts and general parameters are saved
+    assert (os.path.exists('{}/mem_1/run_state.json'.format(rc.ens_dir)))
+
+
+def test_force_tables_saved(rc, tmpdir):
+    rc.build_plugins(EBMetaDPluginConfig())
+    name = rc.pairs.get_names()[0]
+    rc.run_data.save_config('{}/run_config.json'.format(tmpdir))
+    rc.run_data.load_config('{}/run_config.json'.format(tmpdir))
+    assert (rc.run_data.get('force_table', name=name) == rc.pairs[0].build_force_table(w=10, sigma=0.2))
+
+
+def test_resume(rc, tmpdir, data_dir):
+    """
+    A member directory with a complete run_config.json is resumed without re-deriving the run data.
+    """
+    rc.build_plugins(EBMetaDPluginConfig())
+    os.mkdir('{}/mem_1'.format(tmpdir))
+    rc.run_data.save_config('{}/mem_1/run_config.json'.format(tmpdir))
+
+    init = {
+        'tpr': '{}/topol.tpr'.format(data_dir),
+        'ensemble_dir': tmpdir,
+        'ensemble_num': 1,
+        'pairs_json': '{}/pair_data.json'.format(data_dir),
+        'resume': True
+    }
+    # Counts saved after a segment are applied on top of the configuration
+    name = list(rc.run_data.pair_params.keys())[0]
+    nbins = len(rc.run_data.get('force_table', name=name))
+    rc.run_data.set(name=name, distance_counts=[3] * nbins)
+    rc.run_data.save_state('{}/mem_1/run_state.json'.format(tmpdir))
+
+    resumed = RunConfig(**init)
+    assert (resumed.resumed)
+    assert (set(resumed.run_data.pair_params.keys()) == set(rc.run_data.pair_params.keys()))
+    assert (resumed.run_data.get('distance_counts', name=name) == [3] * nbins)
+    resumed.build_plugins(EBMetaDPluginConfig())
+
+    # A different ensemble member does not match the saved fingerprint
+    init['ensemble_num'] = 2
+    os.mkdir('{}/mem_2'.format(tmpdir))
+    rc.run_data.save_config('{}/mem_2/run_config.json'.format(tmpdir))
+    assert (not RunConfig(**init).resumed)
+
+
+def test_rebinned_run(tmpdir, data_dir):
+    init = {
+        'tpr': '{}/topol.tpr'.format(data_dir),
+        'ensemble_dir': tmpdir,
+        'ensemble_num': 1,
+        'pairs_json': '{}/pair_data.json'.format(data_dir),
+        'general_params': {'rebin_ratio': 1}
+    }
+    rc = RunConfig(**init)
+    rc.build_plugins(EBMetaDPluginConfig())
+    name = rc.pairs.get_names()[0]
+    assert (np.isclose(rc.run_data.get('bin_width', name=name), 0.2))
+    assert (len(rc.run_data.get('force_table', name=name)) == 35)
+    assert (len(rc.run_data.get('distance_counts', name=name)) == 35)
+
+
+def test_pairs_follow_rebin_params(rc):
+    """
+    The pairs are rebinned again when sigma or rebin_ratio change after the first access.
+    """
+    name = rc.pairs.get_names()[0]
+    nbins = len(rc.pairs[0].get('bins'))
+    rc.run_data.set(rebin_ratio=1)
+    assert (np.isclose(np.diff(rc.pairs[0].get('bins'))[0], 0.2))
+    rc.run_data.set(sigma=0.4)
+    assert (np.isclose(np.diff(rc.pairs[0].get('bins'))[0], 0.4))
+    rc.run_data.set(rebin_ratio=0)
+    assert (len(rc.pairs[0].get('bins')) == nbins)
+    assert (rc.pairs.get_names()[0] == name)
+
+    # The run data, and so the plugins, follow the grid of the rebinned pairs
+    for sigma, rebin_ratio in [(0.2, 1), (0.4, 1), (0.4, 2)]:
+        rc.run_data.set(sigma=sigma, rebin_ratio=rebin_ratio)
+        rc.build_plugins(EBMetaDPluginConfig())
+        bins = rc.run_data.get('bins', name=name)
+        assert (len(rc.run_data.get('force_table', name=name)) == len(bins))
+        assert (len(rc.run_data.get('distance_counts', name=name)) == len(bins))
+        assert (np.isclose(rc.run_data.get('bin_width', name=name), rebin_ratio * sigma))
+        assert (rc.run_data.get('max_dist', name=name) <= bins[-1])
+        assert (rc.run_data.get('historical_data_filename', name=name) == 'counts_{}.log'.format(name))
+
+
+def test_selected_pairs(tmpdir, data_dir):
+    init = {
+        'tpr': '{}/topol.tpr'.format(data_dir),
+        'ensemble_dir': tmpdir,
+        'ensemble_num': 1,
+        'pairs_json': '{}/pair_data.json'.format(data_dir),
+        'names': ['105_216', '196_228']
+    }
+    rc = RunConfig(**init)
+    rc.build_plugins(EBMetaDPluginConfig())
+    assert (set(rc.run_data.pair_params.keys()) == {'105_216', '196_228'})
+
+    init['names'] = ['not_a_pair']
+    with pytest.raises(ValueError):
+        RunConfig(**init)
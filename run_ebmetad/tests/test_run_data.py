@@ -1,3 +1,7 @@
+from run_ebmetad.run_data import RunData
+from run_ebmetad.metadata import get_json_backend, set_json_backend
+import numpy as np
+import os
 import pytest
 
 
@@ -16,5 +20,87 @@ def test_pair_parameters(run_data):
 
 def test_general_parameters(run_data):
     assert (run_data.general_params.get_requirements() == [
-        'w', 'sigma', 'sample_period', 'k', 'ensemble_num'
+        'w', 'sigma', 'sample_period', 'k', 'ensemble_num', 'rebin_ratio'
     ])
+
+
+def test_state(run_data, tmpdir):
+    """
+    The state file holds the counts and general parameters, but no force table, and only applies to run data with
+    the same fingerprint.
+    """
+    fnm = '{}/run_state.json'.format(tmpdir)
+    name = list(run_data.pair_params.keys())[0]
+    run_data.fingerprint = {'force_table_params': {'w': 10, 'sigma': 0.2}}
+    run_data.set(name=name, force_table=np.ones((70, 70), dtype=np.float32), distance_counts=[2] * 70)
+    run_data.set(k=50.)
+    run_data.save_state(fnm)
+    with open(fnm) as f:
+        assert (os.path.getsize(fnm) < 4 * 70 * 70 and '"force_table"' not in f.read())
+
+    loaded = RunData()
+    loaded.from_dictionary(run_data.as_dictionary())
+    loaded.fingerprint = {'force_table_params': {'w': 10, 'sigma': 0.2}}
+    loaded.set(name=name, distance_counts=[1] * 70)
+    loaded.set(k=10.)
+    assert (loaded.load_state(fnm))
+    assert (loaded.get('distance_counts', name=name) == [2] * 70)
+    assert (loaded.get('k') == 50.)
+
+    loaded.fingerprint = {'force_table_params': {'w': 1, 'sigma': 0.2}}
+    loaded.set(k=10.)
+    assert (not loaded.load_state(fnm))
+    assert (loaded.get('k') == 10.)
+
+
+@pytest.mark.parametrize('backend', ['json', 'orjson'])
+def test_json_backends(run_data, tmpdir, backend):
+    """
+    Run data containing numpy arrays round-trip through every available json backend.
+    """
+    if backend == 'orjson':
+        pytest.importorskip('orjson')
+    previous = get_json_backend()
+    set_json_backend(backend)
+    try:
+        name = list(run_data.pair_params.keys())[0]
+        # 0.1 is not exact in float32: both backends must write the float32 value at float64 precision
+        force_table = np.full((3, 3), 0.1, dtype=np.float32)
+        run_data.set(name=name, force_table=force_table)
+        run_data.save_config('{}/run_config.json'.format(tmpdir))
+        loaded = RunData()
+        loaded.load_config('{}/run_config.json'.format(tmpdir))
+        assert (loaded.get('force_table', name=name) == force_table.tolist())
+        assert (loaded.get('sites', name=name) == run_data.get('sites', name=name))
+    finally:
+        set_json_backend(previous)
+
+
+def test_columns(run_data):
+    """
+    The columnar view is aligned to the pair order, follows set(), and supports bulk updates.
+    """
+    names = run_data.columns.names
+    assert (run_data.columns['bin_width'].tolist() == [run_data.get('bin_width', name=name) for name in names])
+    assert (np.all(run_data.columns['k'] == run_data.get('k')))
+
+    run_data.set(name=names[1], min_dist=1.5)
+    assert (run_data.columns['min_dist'][1] == 1.5)
+
+    run_data.columns.set(max_dist=np.arange(len(names)), bin_width=0.2)
+    assert (run_data.get('max_dist', name=names[2]) == 2)
+    assert (np.all(run_data.columns['bin_width'] == 0.2))
+    with pytest.raises(ValueError):
+        run_data.columns['sites'] = 0
+
+
+def test_bulk_update(run_data):
+    """
+    Bulk updates validate every key before setting anything.
+    """
+    run_data.set(w=5, sigma=0.3)
+    assert (run_data.get('w') == 5 and run_data.get('sigma') == 0.3)
+    with pytest.raises(ValueError):
+        run_data.set(w=1, not_a_parameter=2)
+    assert (run_data.get('w') == 5)
+    assert (run_data.general_params.is_complete())
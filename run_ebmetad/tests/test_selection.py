@@ -0,0 +1,53 @@
+from run_ebmetad.pair_data import MultiPair, PairData
+from run_ebmetad.selection import distribution_matrix, rank_pairs, select_pairs, write_selection
+import numpy as np
+import pytest
+
+
+def test_rank_pairs(multi_pair_data):
+    ranking = rank_pairs(multi_pair_data)
+    assert (sorted(entry['name'] for entry in ranking) == sorted(multi_pair_data.get_names()))
+    # The first pair is the most informative one; nothing is redundant with it
+    assert (ranking[0]['information'] == max(entry['information'] for entry in ranking))
+    assert (ranking[0]['redundancy'] == 0)
+    assert (all(entry['width'] > 0 for entry in ranking))
+
+
+def test_redundant_pair(multi_pair_data):
+    # A copy of a pair is fully redundant and is ranked last
+    pairs = multi_pair_data.get_as_single_dataset()
+    name = multi_pair_data.get_names()[1]
+    pairs['copy'] = dict(pairs[name], name='copy')
+    multi_pair = MultiPair()
+    multi_pair.set_from_dictionary(pairs)
+    ranking = rank_pairs(multi_pair)
+    assert (ranking[-1]['name'] in ['copy', name])
+    assert (np.isclose(ranking[-1]['redundancy'], 1))
+
+
+def test_common_grid():
+    multi_pair = MultiPair()
+    coarse = PairData('coarse')
+    coarse.set_from_dictionary({'bins': [0., 0.2, 0.4, 0.6], 'distribution': [0., 1., 1., 0.], 'sites': [1, 2]})
+    fine = PairData('fine')
+    fine.set_from_dictionary({'bins': [0.2, 0.3, 0.4], 'distribution': [1., 2., 1.], 'sites': [3, 4]})
+    multi_pair.set_from_dictionary({'coarse': coarse.get_as_dictionary(), 'fine': fine.get_as_dictionary()})
+    grid, matrix = distribution_matrix(multi_pair)
+    assert (np.allclose(grid, np.arange(0, 0.65, 0.1)))
+    assert (np.allclose(np.sum(matrix, axis=1), 1))
+
+
+def test_select_pairs(tmpdir, multi_pair_data):
+    names = select_pairs(multi_pair_data, n=2)
+    assert (names == [entry['name'] for entry in rank_pairs(multi_pair_data)][:2])
+    assert (len(select_pairs(multi_pair_data, fraction=0.5)) == 2)
+    with pytest.raises(ValueError):
+        select_pairs(multi_pair_data, fraction=0)
+
+    fnm = '{}/selected.json'.format(tmpdir)
+    write_selection(multi_pair_data, names, fnm)
+    selected = MultiPair()
+    selected.read_from_json(fnm)
+    assert (selected.get_names() == names)
+    with pytest.raises(ValueError):
+        write_selection(multi_pair_data, ['not_a_pair'], fnm)
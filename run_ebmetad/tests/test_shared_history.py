@@ -0,0 +1,35 @@
+from run_ebmetad.shared_history import SharedHistory
+from run_ebmetad.run_config import RunConfig
+from run_ebmetad.plugin_configs import EBMetaDPluginConfig
+import numpy as np
+
+
+def test_shared_history(tmpdir):
+    path = '{}/shared.npy'.format(tmpdir)
+    walker_a = SharedHistory(path, ['a', 'b'], 5)
+    walker_b = SharedHistory(path, ['a', 'b'], 5)
+    assert (np.all(walker_a.get('a') == 1))
+
+    walker_a.contribute({'a': [1, 0, 0, 0, 0]})
+    walker_b.contribute({'a': [0, 2, 0, 0, 0], 'b': [0, 0, 0, 0, 3]})
+    snapshot = walker_b.snapshot()
+    assert (snapshot['a'].tolist() == [2, 3, 1, 1, 1])
+    assert (walker_a.get('b', 5).tolist() == [1, 1, 1, 1, 4])
+
+    walker_a.save_snapshot('{}/snapshot.npy'.format(tmpdir))
+    assert (np.load('{}/snapshot.npy'.format(tmpdir)).shape == (2, 5))
+
+
+def test_shared_history_run_config(tmpdir, data_dir):
+    init = {
+        'tpr': '{}/topol.tpr'.format(data_dir),
+        'ensemble_dir': tmpdir,
+        'ensemble_num': 1,
+        'pairs_json': '{}/pair_data.json'.format(data_dir),
+        'shared_history': '{}/shared.npy'.format(tmpdir)
+    }
+    rc = RunConfig(**init)
+    walker = SharedHistory('{}/shared.npy'.format(tmpdir), rc.pairs.get_names(), 70)
+    walker.contribute({'196_228': np.full(70, 2)})
+    rc.build_plugins(EBMetaDPluginConfig())
+    assert (rc.run_data.get('distance_counts', name='196_228') == [3] * 70)
@@ -0,0 +1,37 @@
+from run_ebmetad.sweep import iter_force_tables, load_combination, load_index, load_pairs, run_sweep, sweep_combination
+import json
+import numpy as np
+
+
+def test_run_sweep(tmpdir, data_dir, multi_pair_data):
+    output_dir = '{}/sweep'.format(tmpdir)
+    index = run_sweep('{}/pair_data.json'.format(data_dir), [0.1, 1.], [0.2, 0.4], output_dir, max_workers=2)
+    assert (load_index(output_dir) == index)
+    assert ([combination['key'] for combination in index['combinations']] ==
+            ['w0.1_s0.2', 'w0.1_s0.4', 'w1.0_s0.2', 'w1.0_s0.4'])
+    assert (index['names'] == multi_pair_data.get_names())
+
+    tables = load_combination(output_dir, 1., 0.4)
+    for pd in multi_pair_data:
+        expected = np.array(pd.build_force_table(w=1., sigma=0.4), dtype=np.float32)
+        assert (np.array_equal(tables[pd.name], expected))
+
+
+def test_load_pairs(tmpdir, raw_pair_data):
+    """
+    The per-process pair data follow changes of the file, and no kernel outlives its combination.
+    """
+    fnm = '{}/pair_data.json'.format(tmpdir)
+    json.dump(raw_pair_data, open(fnm, 'w'))
+    multi_pair = load_pairs(fnm)
+    assert (load_pairs(fnm) is multi_pair)
+    assert (multi_pair.get_names() == list(raw_pair_data))
+
+    for _ in iter_force_tables(multi_pair, [1.], [0.2, 0.4]):
+        assert (len(multi_pair.kernel_cache) == 0)
+    sweep_combination(multi_pair, str(tmpdir), 1., 0.2)
+    assert (len(multi_pair.kernel_cache) == 0)
+
+    del raw_pair_data[list(raw_pair_data)[0]]
+    json.dump(raw_pair_data, open(fnm, 'w'))
+    assert (load_pairs(fnm).get_names() == list(raw_pair_data))
@@ -0,0 +1,55 @@
+from run_ebmetad.pair_data import MultiPair
+from run_ebmetad.tuning import apply_tuning, score_pair, toy_sampling, tune
+import numpy as np
+import pytest
+
+
+def test_score_pair(multi_pair_data):
+    pd = multi_pair_data[0]
+    # Gaussians narrower than two bins are penalized, as are Gaussians wider than the distribution
+    assert (score_pair(pd, 10, 0.05)['resolution'] > 0)
+    assert (score_pair(pd, 10, 0.2)['resolution'] == 0)
+    assert (score_pair(pd, 10, 5.)['smoothing'] > 0)
+    terms = score_pair(pd, 10, 0.2, toy_steps=500)
+    assert (0 <= terms['toy'] <= 1)
+    assert (np.isclose(terms['score'], terms['magnitude'] + terms['resolution'] + terms['smoothing'] + terms['toy']))
+
+
+def test_toy_sampling(multi_pair_data):
+    pd = multi_pair_data[0]
+    histogram = toy_sampling(pd, 10, 0.2, 1000, sample_period=2)
+    assert (np.sum(histogram) == 500)
+    assert (np.array_equal(histogram, toy_sampling(pd, 10, 0.2, 1000, sample_period=2)))
+
+
+def test_tune(multi_pair_data, run_data):
+    results = tune(multi_pair_data, [1, 10], [0.05, 0.2], max_workers=2)
+    assert (len(results) == 4)
+    assert ([result['score'] for result in results] == sorted(result['score'] for result in results))
+    assert (set(results[0]['pairs']) == set(multi_pair_data.get_names()))
+    assert (results[0]['sigma'] == 0.2)
+
+    assert (apply_tuning(run_data, results) == (results[0]['w'], 0.2))
+    assert (run_data.get('sigma') == 0.2)
+    with pytest.raises(ValueError):
+        apply_tuning(run_data, [])
+
+
+def test_tune_gaussian():
+    """
+    For a Gaussian DEER distribution of width 0.4 on a 0.1 grid, sigma = 0.2 is the only width neither too narrow for
+    the grid nor too wide for the distribution, and w = 0.1 brings the largest force (table times distance) closest
+    to the target of 100.
+    """
+    bins = np.round(np.arange(70) * 0.1, 10)
+    distribution = np.exp(-(bins - 3.5)**2 / (2 * 0.4**2))
+    distribution /= np.sum(distribution)
+    multi_pair = MultiPair()
+    multi_pair.set_from_dictionary({'gaussian': {'sites': [1, 2], 'bins': bins.tolist(),
+                                                 'distribution': distribution.tolist()}})
+    pd = multi_pair[0]
+    force = np.asarray(pd.build_force_table(w=0.1, sigma=0.2)) * bins[:, None]
+    assert (np.isclose(score_pair(pd, 0.1, 0.2)['magnitude'], np.log10(np.max(np.abs(force)) / 100.)**2))
+
+    results = tune(multi_pair, [0.01, 0.1, 1, 10], [0.1, 0.2, 0.4], toy_steps=2000, max_workers=2)
+    assert ((results[0]['w'], results[0]['sigma']) == (0.1, 0.2))
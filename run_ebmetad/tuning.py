@@ -0,0 +1,136 @@
+"""
+Automatic selection of the Metadynamics parameters 'w' and 'sigma' from cheap surrogate scores.
+Every candidate (w, sigma) is scored for every pair without running MD; lower scores are better. The terms are
+    magnitude:  (log10(max |force| / target_force))^2, from the force table times the distance (the table holds the
+                force divided by the distance, and includes the effective volume of the DEER distribution through
+                the pre-factor)
+    resolution: penalty for Gaussians narrower than two bins, ((2 - sigma / bin_width) / 2)^2
+    smoothing:  penalty for Gaussians wider than half the distribution width, ((sigma / width - 0.5) / 0.5)^2
+    toy:        optionally, the Jensen-Shannon divergence (in units of log 2) between the DEER distribution and a short
+                Monte Carlo run of a free 1D walker under the EBMetaD bias
+w and sigma are general parameters, so a candidate's score is the sum of its pair scores, and the best candidate is
+written into RunData for all restraints.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from run_ebmetad.bias import integrate_force_table
+from run_ebmetad.convergence import js_divergence
+from run_ebmetad.reweight import KT_300K
+from run_ebmetad.run_data import get_min_max
+
+
+def distribution_width(pd):
+    """
+    :param pd: PairData
+    :return: standard deviation of the DEER distribution.
+    """
+    bins = np.asarray(pd.get('bins'), dtype=np.float64)
+    probs = np.asarray(pd.get('distribution'), dtype=np.float64)
+    probs = probs / np.sum(probs)
+    mean = np.sum(probs * bins)
+    return float(np.sqrt(np.sum(probs * (bins - mean)**2)))
+
+
+def toy_sampling(pd, w, sigma, steps, sample_period=1, kT=KT_300K, seed=0):
+    """
+    Metropolis Monte Carlo of a walker hopping between neighbouring bins with no potential other than the EBMetaD
+    bias, whose history is updated every sample_period steps as in the plugin. The walker is confined to the distances
+    where the restraint is active (see run_data.get_min_max).
+    :param pd: PairData
+    :param w: weight, or height, of the Gaussians.
+    :param sigma: width of the Gaussians.
+    :param steps: number of Monte Carlo steps.
+    :param sample_period: steps between updates of the history.
+    :param kT: thermal energy, in the units of the force table times distance.
+    :param seed: random seed.
+    :return: histogram of the visited bins.
+    """
+    bins = np.asarray(pd.get('bins'), dtype=np.float64)
+    potential_table = integrate_force_table(pd.build_force_table(w=w, sigma=sigma), bins, sigma)
+    min_dist, max_dist = get_min_max(pd.get('distribution'), bins)
+    lo, hi = np.searchsorted(bins, min_dist), np.searchsorted(bins, max_dist)
+    profile = potential_table.sum(axis=1)  # bias of a history of all ones
+    histogram = np.zeros(len(bins))
+
+    random = np.random.RandomState(seed)
+    moves = random.choice([-1, 1], size=steps)
+    log_uniform = np.log(random.random_sample(steps))
+    i = int(np.argmax(pd.get('distribution')))
+    for step in range(steps):
+        j = min(max(i + moves[step], lo), hi)
+        if log_uniform[step] < (profile[i] - profile[j]) / kT:
+            i = j
+        if step % sample_period == 0:
+            profile += potential_table[:, i]
+            histogram[i] += 1
+    return histogram
+
+
+def score_pair(pd, w, sigma, target_force=100., toy_steps=0, kT=KT_300K, seed=0):
+    """
+    Surrogate score of one (w, sigma) candidate for one pair (see the module docstring).
+    :param pd: PairData
+    :param w: weight, or height, of the Gaussians.
+    :param sigma: width of the Gaussians.
+    :param target_force: desired largest force.
+    :param toy_steps: number of toy Monte Carlo steps; 0 skips the toy model.
+    :param kT: thermal energy used by the toy model.
+    :param seed: random seed of the toy model.
+    :return: dictionary of score terms, and their sum under 'score'.
+    """
+    bins = np.asarray(pd.get('bins'), dtype=np.float64)
+    bin_width = float(np.min(np.diff(bins)))
+    max_force = float(np.max(np.abs(np.asarray(pd.build_force_table(w=w, sigma=sigma)) * bins[:, None])))
+
+    terms = {
+        'magnitude': np.log10(max_force / target_force)**2 if max_force > 0 else np.inf,
+        'resolution': max(0., (2. - sigma / bin_width) / 2.)**2,
+        'smoothing': max(0., (sigma / distribution_width(pd) - 0.5) / 0.5)**2
+    }
+    if toy_steps:
+        sampled = toy_sampling(pd, w, sigma, toy_steps, kT=kT, seed=seed)
+        terms['toy'] = float(js_divergence(pd.get('distribution'), sampled)) / np.log(2)
+    terms = {key: float(value) for key, value in terms.items()}
+    terms['score'] = sum(terms.values())
+    return terms
+
+
+def _score_candidate(args):
+    multi_pair, w, sigma, options = args
+    pairs = {pd.name: score_pair(pd, w, sigma, **options) for pd in multi_pair}
+    return {'w': w, 'sigma': sigma, 'score': sum(terms['score'] for terms in pairs.values()), 'pairs': pairs}
+
+
+def tune(multi_pair, weights, sigmas, target_force=100., toy_steps=0, kT=KT_300K, seed=0, max_workers=None):
+    """
+    Score every (w, sigma) candidate for every pair, in a process pool.
+    :param multi_pair: MultiPair holding the pair data.
+    :param weights: list of candidate w values.
+    :param sigmas: list of candidate sigma values.
+    :param target_force: desired largest force.
+    :param toy_steps: number of toy Monte Carlo steps per pair and candidate; 0 skips the toy model.
+    :param kT: thermal energy used by the toy model.
+    :param seed: random seed of the toy model.
+    :param max_workers: size of the process pool.
+    :return: list of {'w', 'sigma', 'score', 'pairs': {name: terms}}, best candidate first.
+    """
+    options = {'target_force': target_force, 'toy_steps': toy_steps, 'kT': kT, 'seed': seed}
+    candidates = [(multi_pair, w, s, options) for w in weights for s in sigmas]
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        results = list(executor.map(_score_candidate, candidates))
+    return sorted(results, key=lambda result: result['score'])
+
+
+def apply_tuning(run_data, results):
+    """
+    Write the best candidate into the general parameters of a RunData object.
+    :param run_data: RunData
+    :param results: output of tune.
+    :return: the chosen (w, sigma).
+    """
+    if not results:
+        raise ValueError('No tuning results to apply')
+    best = results[0]
+    run_data.set(w=best['w'], sigma=best['sigma'])
+    return best['w'], best['sigma']
@@ -13,6 +13,9 @@ if __name__ == "__main__":
         packages=setuptools.find_packages(),
         install_requires=[],
         extras_require={
+            'fast': [
+                'orjson',
+            ],
             'docs': [
                 'sphinx',
                 'sphinxcontrib-napoleon',